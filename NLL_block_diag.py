@@ -1,6 +1,9 @@
 import torch
 from torch.distributions import MultivariateNormal
 
+from likelihoods import BlockDiagonalGaussian
+
+
 def mvg_nll_block(cov,x,mu,n):
     d = x.shape[0]
     num_blocks = d//n
@@ -23,4 +26,23 @@ def mvg_nll_block(cov,x,mu,n):
         z_rem = z[num_blocks * n:]
         log_likelihood += mvn_rem.log_prob(z_rem)
 
-    return -log_likelihood
\ No newline at end of file
+    return -log_likelihood
+
+def mvg_nll_block_batched(cov, x, mu, n):
+    """
+    Batched block-diagonal NLL, matching the per-block loop that option 4 of
+    main_autoencoder_option4.py used before BlockDiagonalGaussian: the true
+    diagonal blocks cov[i*n:(i+1)*n, i*n:(i+1)*n] and cov[-r:, -r:] for the
+    r = d % n remainder pixels, factorised in one batched call and solved over
+    (batch, num_blocks, n). This differs from mvg_nll_block above, which takes a
+    1-D x and reuses cov[:n, :n] and cov[:r, :r] for every block (the same
+    blocks only when n is a multiple of the image width). When cov is fixed,
+    build a likelihoods.BlockDiagonalGaussian once instead.
+    Inputs:
+      - cov: (d, d) covariance matrix
+      - x, mu: (batch, d) flattened data and mean
+      - n: block size
+    Outputs:
+      - (batch,) negative log-likelihoods
+    """
+    return BlockDiagonalGaussian(cov, n, device=x.device, dtype=x.dtype).nll(x, mu)
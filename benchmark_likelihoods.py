@@ -0,0 +1,161 @@
+import time
+import numpy as np
+import torch
+
+from covariance import find_correlation_matrix, find_cutoff_distance
+from likelihoods import (
+    BandedGaussian,
+    BlockDiagonalGaussian,
+    CholeskyGaussian,
+    GMRFGaussian,
+    HODLRGaussian,
+    KroneckerGaussian,
+    LowRankGaussian,
+    PRECISION_POLICIES,
+    PCGGaussian,
+    SparseCholeskyGaussian,
+    TileGaussian,
+    VecchiaGaussian,
+    WhittleGaussian,
+)
+from psf_operator import PSFNoiseSampler
+
+
+def cholesky_nll(cov, x, mu):
+    """
+    Exact reference NLL from a dense float64 Cholesky factor.
+    Inputs:
+      - cov: (d, d) covariance matrix
+      - x, mu: (batch, d) data and mean
+    Outputs:
+      - (batch,) negative log-likelihoods
+    """
+    L = torch.linalg.cholesky(cov.double())
+    z = (x - mu).double()
+    y = torch.linalg.solve_triangular(L, z.T, upper=False)
+    log_det = 2 * torch.sum(torch.log(torch.diagonal(L)))
+    return 0.5 * ((y**2).sum(dim=0) + log_det + cov.shape[0] * np.log(2 * np.pi))
+
+
+def time_call(fn, *args, repeats=10):
+    """
+    Average wall time of fn(*args) over repeats, after one warm-up call.
+    """
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args)
+    return (time.perf_counter() - start) / repeats
+
+
+def compare_likelihoods(engines, cov, x, mu, repeats=10):
+    """
+    Relative NLL error and time per batch of each engine against cholesky_nll.
+    Inputs:
+      - engines: dict of name -> callable(x, mu) returning (batch,) NLLs
+      - cov, x, mu: as in cholesky_nll
+    Outputs:
+      - dict of name -> (max relative error, seconds per call)
+    """
+    reference = cholesky_nll(cov, x, mu)
+    results = {"cholesky": (0.0, time_call(cholesky_nll, cov, x, mu, repeats=repeats))}
+    for name, nll in engines.items():
+        with torch.no_grad():
+            value = nll(x, mu).double()
+        rel_error = ((value - reference).abs() / reference.abs()).max().item()
+        results[name] = (rel_error, time_call(nll, x, mu, repeats=repeats))
+    return results
+
+
+def precision_policy_report(cov, x, mu, policies=PRECISION_POLICIES, repeats=10):
+    """
+    Relative NLL error and time per batch of CholeskyGaussian under each
+    precision policy, against cholesky_nll. The factor and log-determinant
+    are computed once in float64 and then cast to each policy's storage dtype.
+    Pass float64 x and mu, so that only the policy rounds: each engine returns
+    its NLL in its solve dtype.
+    Outputs:
+      - dict of policy -> (max relative error, seconds per call)
+    """
+    L = torch.linalg.cholesky(cov.double())
+    log_det = 2 * torch.log(torch.diagonal(L)).sum().item()
+    engines = {name: CholeskyGaussian.with_policy(L, log_det, name).nll for name in policies}
+    results = compare_likelihoods(engines, cov, x, mu, repeats=repeats)
+    del results["cholesky"]
+    return results
+
+
+def fastest_within_tolerance(results, tol):
+    """
+    Name of the fastest entry of results (as from compare_likelihoods) whose
+    relative error is at most tol, or None if there is none.
+    """
+    within = [(seconds, name) for name, (rel_error, seconds) in results.items() if rel_error <= tol]
+    return min(within)[1] if within else None
+
+
+def low_rank_accuracy_curve(image_size, sigma, ranks, x, mu):
+    """
+    Relative NLL error of LowRankGaussian against the exact KroneckerGaussian
+    NLL, for each rank. Needs no dense matrix, so works at the full image size.
+    Outputs:
+      - dict of rank -> max relative error over the batch
+    """
+    reference = KroneckerGaussian(image_size, sigma, dtype=torch.float64).nll(x.double(), mu.double())
+    curve = {}
+    for rank in ranks:
+        value = LowRankGaussian.from_psf(image_size, sigma, rank).nll(x, mu).double()
+        curve[rank] = ((value - reference).abs() / reference.abs()).max().item()
+    return curve
+
+
+if __name__ == "__main__":
+    image_size = 50  # Kept small enough for the dense reference
+    sigma = 5.4 / (2 * np.sqrt(2 * np.log(2)))
+    batch_size = 16
+
+    cov = torch.tensor(find_correlation_matrix(image_size, sigma), dtype=torch.float64)
+
+    # Residuals drawn from the PSF covariance itself, as for a well-fitted model
+    sampler = PSFNoiseSampler.from_psf(image_size, sigma, seed=0, dtype=torch.float64)
+    x = sampler.sample(batch_size).reshape(batch_size, -1).float()
+    mu = torch.zeros_like(x)
+
+    engines = {
+        "kronecker": KroneckerGaussian(image_size, sigma).nll,
+        "whittle": WhittleGaussian(image_size, sigma).nll,
+        # Equal block size: runs of 144 pixels against 12x12 tiles
+        "block 144": BlockDiagonalGaussian(cov.float(), 144, image_width=image_size).nll,
+        "tile 12x12": TileGaussian.from_psf(image_size, sigma, 12).nll,
+        "banded": BandedGaussian.from_psf(image_size, sigma, image_size).nll,
+        "sparse chol.": SparseCholeskyGaussian.from_psf(image_size, sigma, find_cutoff_distance(0.9999, sigma)).nll,
+        "gmrf r=1": GMRFGaussian.from_psf(image_size, sigma, 1).nll,
+        "gmrf r=2": GMRFGaussian.from_psf(image_size, sigma, 2).nll,
+        "gmrf r=3": GMRFGaussian.from_psf(image_size, sigma, 3).nll,
+        "vecchia m=10": VecchiaGaussian.from_psf(image_size, sigma, 10).nll,
+        "vecchia m=30": VecchiaGaussian.from_psf(image_size, sigma, 30).nll,
+        # Warm starts would make repeated calls on the same batch free
+        "pcg": PCGGaussian.from_psf(image_size, sigma, warm_start=False).nll,
+        "hodlr": HODLRGaussian.from_psf(image_size, sigma).nll,
+    }
+
+    results = compare_likelihoods(engines, cov, x, mu)
+    print(f"{'engine':<12}{'rel. error':>14}{'time / batch':>16}")
+    for name, (rel_error, seconds) in results.items():
+        print(f"{name:<12}{rel_error:>14.2e}{seconds:>14.2e} s")
+
+    # Storage/solve dtypes of the dense factor, on the same residuals in float64
+    policies = precision_policy_report(cov, x.double(), mu.double())
+    print(f"\n{'policy':<18}{'rel. error':>14}{'time / batch':>16}")
+    for name, (rel_error, seconds) in policies.items():
+        print(f"{name:<18}{rel_error:>14.2e}{seconds:>14.2e} s")
+    print("fastest within 1e-6:", fastest_within_tolerance(policies, 1e-6))
+
+    # Accuracy against rank for the FIRST PSF at the full image size
+    full_size = 150
+    sampler = PSFNoiseSampler.from_psf(full_size, sigma, seed=0, dtype=torch.float64)
+    x = sampler.sample(batch_size).reshape(batch_size, -1).float()
+    curve = low_rank_accuracy_curve(full_size, sigma, [10, 50, 100, 250, 500, 1000, 2000], x, torch.zeros_like(x))
+    print(f"\n{'rank':<12}{'rel. error':>14}")
+    for rank, rel_error in curve.items():
+        print(f"{rank:<12}{rel_error:>14.2e}")
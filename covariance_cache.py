@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from covariance import covariance_from_kernel, find_beam_covariance_matrix, find_correlation_kernel
+
+
+class CovarianceCache:
+    """
+    Content-addressed on-disk cache for covariance matrices, factors,
+    log-determinants and eigenbases.
+
+    Each entry is a directory named by a hash of the parameters that define it
+    (image_size, sigma, pixel_scale, fwhm_major/minor, block size, dtype,
+    strategy, ...), holding one .npy per array and a meta.json. Entries are
+    written to a temporary directory and renamed into place, so a crashed or
+    concurrent run never sees a half-written entry. Arrays are loaded as
+    read-only memory maps. When max_bytes is set, the least recently used
+    entries are evicted after each store.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = os.path.expanduser(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(**params):
+        """
+        Hash of the parameters defining an entry. Values must be JSON-serialisable
+        (NumPy scalars and dtypes are converted).
+        """
+        def normalise(value):
+            if isinstance(value, (np.generic,)):
+                return value.item()
+            if isinstance(value, (type, np.dtype)):
+                return np.dtype(value).name
+            return value
+
+        params = {name: normalise(value) for name, value in params.items()}
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:32]
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def load(self, key):
+        """
+        Outputs:
+          - dict of name -> read-only np.memmap, or None if the entry is missing.
+        """
+        entry = self._entry(key)
+        meta_path = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        os.utime(meta_path)  # Mark as recently used
+        return {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode="r") for name in meta["arrays"]}
+
+    def store(self, key, arrays, params=None):
+        """
+        Atomically write a dict of name -> array under key, then evict old entries.
+        """
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + ".npy"), np.asarray(array))
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"arrays": list(arrays), "params": params}, f, default=str)
+            try:
+                os.rename(tmp, self._entry(key))
+            except OSError:
+                # Another process stored the same entry first; theirs is identical
+                shutil.rmtree(tmp)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return self.load(key)
+
+    def get_or_compute(self, compute, **params):
+        """
+        Load the entry for params, or build it with compute() -> dict of arrays and store it.
+        """
+        key = self.key(**params)
+        arrays = self.load(key)
+        if arrays is None:
+            arrays = self.store(key, compute(), params=params)
+        return arrays
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for key in os.listdir(self.root):
+            meta_path = os.path.join(self._entry(key), "meta.json")
+            if key.startswith(".tmp-") or not os.path.exists(meta_path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(self._entry(key)))
+            entries.append((os.path.getmtime(meta_path), size, key))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+
+def _cached_cholesky(cache, build_matrix, dtype, **params):
+    """
+    Lower Cholesky factor (stored in dtype) and float64 log-determinant of
+    build_matrix(), keyed by params.
+    """
+    def compute():
+        L = np.linalg.cholesky(build_matrix())
+        log_det = 2 * np.sum(np.log(np.diag(L)))
+        return {"scale_tril": L.astype(dtype), "log_det": np.float64(log_det)}
+
+    arrays = cache.get_or_compute(compute, dtype=dtype, strategy="full_cholesky", **params)
+    return arrays["scale_tril"], float(arrays["log_det"])
+
+
+def cached_cholesky_factor(cache, image_size, sigma, pixel_scale=1.8, dtype=np.float32):
+    """
+    Lower Cholesky factor and log-determinant of find_correlation_matrix, from
+    the cache if present. The factorisation is done in float64 and the factor
+    stored in dtype.
+    Outputs:
+      - L: (N, N) read-only np.memmap
+      - log_det: float
+    """
+    return _cached_cholesky(
+        cache, lambda: covariance_from_kernel(find_correlation_kernel(image_size, sigma, pixel_scale)), dtype,
+        image_size=image_size, sigma=sigma, pixel_scale=pixel_scale,
+    )
+
+
+def cached_correlation_matrix(cache, image_size, sigma, pixel_scale=1.8, dtype=np.float32):
+    """
+    find_correlation_matrix stored in dtype, from the cache if present. It is
+    built in row tiles from the lag kernel, so no (N, N) float64 temporaries are made.
+    Outputs:
+      - (N, N) read-only np.memmap
+    """
+    def compute():
+        kernel = find_correlation_kernel(image_size, sigma, pixel_scale)
+        return {"correlation_matrix": covariance_from_kernel(kernel, dtype=dtype)}
+
+    arrays = cache.get_or_compute(
+        compute, image_size=image_size, sigma=sigma, pixel_scale=pixel_scale, dtype=dtype, strategy="matrix",
+    )
+    return arrays["correlation_matrix"]
+
+
+def cached_beam_cholesky_factor(cache, image_size, fwhm_major, fwhm_minor, pixel_scale=1.8,
+                                position_angle=0.0, dtype=np.float32):
+    """
+    As cached_cholesky_factor, for the elliptical beam of find_beam_covariance_matrix.
+    """
+    return _cached_cholesky(
+        cache,
+        lambda: find_beam_covariance_matrix(image_size, fwhm_major, fwhm_minor, pixel_scale, position_angle),
+        dtype,
+        image_size=image_size, fwhm_major=fwhm_major, fwhm_minor=fwhm_minor,
+        pixel_scale=pixel_scale, position_angle=position_angle,
+    )
@@ -24,6 +24,8 @@ from torch.utils.data import Subset
 from einops import rearrange
 from torchvision.transforms.functional import center_crop, resize
 
+from covariance import find_beam_regime
+
 #from byol.utilities import rgz_cut
 #from byol.paths import Path_Handler
 
@@ -81,12 +83,15 @@ class MiraBest_F(data.Dataset):
         test_size=None,
         aug_type="torchvision",
         data_type="double",
+        return_regime=False,
     ):
         self.root = os.path.expanduser(root)
         self.transform = transform
         self.target_transform = target_transform
         self.train = train  # training set or test set
         self.aug_type = aug_type
+        # If set, __getitem__ also returns the beam regime, for PSFRegimeGaussian.nll
+        self.return_regime = return_regime
 
         if download:
             self.download()
@@ -129,6 +134,8 @@ class MiraBest_F(data.Dataset):
         self.las = [float(filename[-11:-4]) for filename in self.filenames]
         self.ra = [float(filename[-26:-19]) for filename in self.filenames]
         self.dec = [float(filename[-34:-27]) for filename in self.filenames]
+        # FIRST beam regime of each source (index into covariance.FIRST_BEAMS)
+        self.beam_regimes = find_beam_regime(self.ra, self.dec)
 
         self.data = np.vstack(self.data).reshape(-1, 1, 150, 150)
         self.data = self.data.transpose((0, 2, 3, 1))
@@ -136,9 +143,10 @@ class MiraBest_F(data.Dataset):
 
         # Stratify entire data set according to input ratio (seeded)
         if test_size is not None:
-            data_train, data_test, targets_train, targets_test = train_test_split(
+            data_train, data_test, targets_train, targets_test, regimes_train, regimes_test = train_test_split(
                 self.data,
                 self.targets,
+                self.beam_regimes,
                 test_size=test_size,
                 stratify=self.targets,  # Targets to stratify according to
                 random_state=42,
@@ -147,10 +155,12 @@ class MiraBest_F(data.Dataset):
                 self.data = data_train
                 self.targets = targets_train
                 self.full_targets = targets_train
+                self.beam_regimes = regimes_train
             else:
                 self.data = data_test
                 self.targets = targets_test
                 self.full_targets = targets_test
+                self.beam_regimes = regimes_test
 
         self._load_meta()
 
@@ -174,7 +184,9 @@ class MiraBest_F(data.Dataset):
         Args:
             index (int): Index
         Returns:
-            tuple: (image, target) where target is index of the target class.
+            tuple: (image, target) where target is index of the target class,
+            or (image, target, regime) with return_regime set, where regime is
+            the index of the source's beam in covariance.FIRST_BEAMS.
         """
         img, target = self.data[index], self.targets[index]
 
@@ -201,6 +213,8 @@ class MiraBest_F(data.Dataset):
                 f"{self.aug_type} not implemented. Currently 'aug_type' must be either 'albumentations' which defaults to Albumentations or 'torchvision' to be functional."
             )
 
+        if self.return_regime:
+            return img, target, int(self.beam_regimes[index])
         return img, target
 
     def __len__(self):
@@ -279,6 +293,7 @@ class MBFRFull(MiraBest_F):
 
             # Remove excluded labels
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
         else:
@@ -293,6 +308,7 @@ class MBFRFull(MiraBest_F):
             targets[fr1_mask] = 0  # set all FRI to Class~0
             targets[fr2_mask] = 1  # set all FRII to Class~1
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
 
@@ -324,6 +340,7 @@ class MBFRConfident(MiraBest_F):
             targets[fr1_mask] = 0  # set all FRI to Class~0
             targets[fr2_mask] = 1  # set all FRII to Class~1
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
         else:
@@ -337,6 +354,7 @@ class MBFRConfident(MiraBest_F):
             targets[fr1_mask] = 0  # set all FRI to Class~0
             targets[fr2_mask] = 1  # set all FRII to Class~1
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
 
@@ -368,6 +386,7 @@ class MBFRUncertain(MiraBest_F):
             targets[fr1_mask] = 0  # set all FRI to Class~0
             targets[fr2_mask] = 1  # set all FRII to Class~1
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
         else:
@@ -381,6 +400,7 @@ class MBFRUncertain(MiraBest_F):
             targets[fr1_mask] = 0  # set all FRI to Class~0
             targets[fr2_mask] = 1  # set all FRII to Class~1
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
 
@@ -412,6 +432,7 @@ class MBHybrid(MiraBest_F):
             targets[fr1_mask] = 0  # set all FRI to Class~0
             targets[fr2_mask] = 1  # set all FRII to Class~1
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
         else:
@@ -425,6 +446,7 @@ class MBHybrid(MiraBest_F):
             targets[fr1_mask] = 0  # set all FRI to Class~0
             targets[fr2_mask] = 1  # set all FRII to Class~1
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
             self.full_targets = np.array(self.full_targets)[exclude_mask].tolist()
 
@@ -481,6 +503,7 @@ class MBRandom(MiraBest_F):
             target_list = np.concatenate((h1_random, h2_random))
             exclude_mask = (targets.reshape(-1, 1) == target_list).any(axis=1)
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
         else:
             targets = np.array(self.targets)
@@ -497,6 +520,7 @@ class MBRandom(MiraBest_F):
             target_list = np.concatenate((h1_random, h2_random))
             exclude_mask = (targets.reshape(-1, 1) == target_list).any(axis=1)
             self.data = self.data[exclude_mask]
+            self.beam_regimes = self.beam_regimes[exclude_mask]
             self.targets = targets[exclude_mask].tolist()
 
 
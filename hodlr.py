@@ -0,0 +1,252 @@
+import numpy as np
+import torch
+
+from covariance import find_beam_kernel, find_correlation_kernel
+
+
+def quadtree_partition(image_size, leaf_size):
+    """
+    Recursive bisection of the image into rectangles, always halving the
+    longer side, until each holds at most leaf_size pixels. Listing the pixels
+    leaf by leaf gives an ordering in which every node of the tree is a
+    contiguous index range and a compact patch of the image.
+    Outputs:
+      - order: (N,) row-major pixel index at each position
+      - nodes: (num_nodes, 9) int array of
+        start, stop, left, right, row0, row1, col0, col1, axis
+        (left = right = -1 for leaves; axis is 0 for a split between rows,
+        1 between columns). Children come after their parent; node 0 is the root.
+    """
+    pixels = np.arange(image_size**2).reshape(image_size, image_size)
+    order, nodes = [], []
+
+    def split(rows, cols):
+        index = len(nodes)
+        nodes.append(None)
+        (r0, r1), (c0, c1) = rows, cols
+        start = sum(len(block) for block in order)
+        if (r1 - r0) * (c1 - c0) <= leaf_size:
+            order.append(pixels[r0:r1, c0:c1].ravel())
+            nodes[index] = [start, start + (r1 - r0) * (c1 - c0), -1, -1, r0, r1, c0, c1, -1]
+            return index
+        if r1 - r0 >= c1 - c0:
+            middle, axis = (r0 + r1) // 2, 0
+            left, right = split((r0, middle), cols), split((middle, r1), cols)
+        else:
+            middle, axis = (c0 + c1) // 2, 1
+            left, right = split(rows, (c0, middle)), split(rows, (middle, c1))
+        nodes[index] = [start, nodes[right][1], left, right, r0, r1, c0, c1, axis]
+        return index
+
+    split((0, image_size), (0, image_size))
+    return np.concatenate(order), np.array(nodes, dtype=np.int64)
+
+
+def _kernel_reach(kernel, tol):
+    """
+    Largest Chebyshev lag at which the kernel (off its centre) still exceeds tol.
+    """
+    centre = (kernel.shape[0] - 1) // 2
+    lags = np.abs(np.arange(kernel.shape[0]) - centre)
+    chebyshev = np.maximum(lags[:, None], lags[None, :])
+    above = (np.abs(kernel) > tol) & (chebyshev > 0)
+    return int(chebyshev[above].max()) if above.any() else 0
+
+
+class HODLRCovariance:
+    """
+    Hierarchical off-diagonal low-rank (HODLR) representation of a stationary
+    covariance, in the ordering of quadtree_partition. Each node splits as
+        K = [[K1, U V^T], [V U^T, K2]] = blockdiag(K1, K2) + W M W^T,
+        W = blockdiag(U, V),  M = [[0, I], [I, 0]]
+    and leaves are dense Cholesky factors. By Woodbury and the determinant lemma,
+        K^-1 b = D^-1 b - D^-1 W C^-1 W^T D^-1 b,  C = M + W^T D^-1 W
+        log|K| = log|K1| + log|K2| + log det(I - G1 G2),  G1 = U^T K1^-1 U, G2 = V^T K2^-1 V
+    so a solve costs O(N r log N) and the log-determinant is summed once at setup.
+
+    The kernel is short-ranged, so only pixels within its reach of the split
+    line couple across it. Each off-diagonal block is the SVD of that strip
+    block, truncated at singular values below tol, and entries of the kernel
+    below tol are dropped. A node whose halves have no coupling above tol keeps
+    no low-rank term and is solved as blockdiag(K1, K2).
+    """
+
+    def __init__(self, arrays, log_det):
+        """
+        Use from_kernel, from_psf, from_beam, load or cached_psf_hodlr.
+        Inputs:
+          - arrays: dict of name -> tensor, as built by from_kernel.
+          - log_det: float64 log-determinant.
+        """
+        self.arrays = arrays
+        self.nodes = arrays["nodes"].cpu().numpy()
+        self.log_det = float(log_det)
+        self.d = arrays["order"].shape[0]
+
+    @classmethod
+    def from_kernel(cls, kernel, tol=1e-6, leaf_size=256):
+        """
+        Inputs:
+          - kernel: (2n-1, 2n-1) lag kernel, as from find_correlation_kernel.
+          - tol: truncation of the kernel and of the off-diagonal singular values.
+          - leaf_size: largest number of pixels in a dense leaf block.
+        """
+        image_size = (kernel.shape[0] + 1) // 2
+        centre = image_size - 1
+        order, nodes = quadtree_partition(image_size, leaf_size)
+        i, j = np.divmod(order, image_size)  # Pixel coordinates at each position
+        reach = _kernel_reach(kernel, tol)
+
+        def block(rows, cols):
+            return kernel[i[rows][:, None] - i[cols][None, :] + centre, j[rows][:, None] - j[cols][None, :] + centre]
+
+        arrays = {"order": torch.tensor(order), "nodes": torch.tensor(nodes)}
+        hodlr = cls(arrays, 0.0)
+        log_det = 0.0
+        # Children come after their parents, so factorise from the last node back
+        for k in range(len(nodes) - 1, -1, -1):
+            start, stop, left, right, r0, r1, c0, c1, axis = nodes[k]
+            if left < 0:
+                positions = np.arange(start, stop)
+                L = np.linalg.cholesky(block(positions, positions))
+                arrays[f"{k}_leaf"] = torch.tensor(L)
+                log_det += 2 * np.sum(np.log(np.diag(L)))
+                continue
+
+            middle = nodes[right][0]
+            split = (i if axis == 0 else j)
+            line = nodes[right][4] if axis == 0 else nodes[right][6]
+            strip1 = np.arange(start, middle)[split[start:middle] >= line - reach]
+            strip2 = np.arange(middle, stop)[split[middle:stop] < line + reach]
+            if len(strip1) == 0 or len(strip2) == 0:
+                continue  # Nothing above tol couples the halves, so the node is block-diagonal
+            U_s, s, Vt_s = np.linalg.svd(block(strip1, strip2), full_matrices=False)
+            rank = int(np.sum(s > tol))
+            if rank == 0:
+                continue
+            # U and V vanish off the strips, so only their strip rows are kept
+            rows1, rows2 = torch.tensor(strip1 - start), torch.tensor(strip2 - middle)
+            U = torch.tensor(U_s[:, :rank] * s[:rank])
+            V = torch.tensor(Vt_s[:rank].T)
+
+            P1 = hodlr._solve_node(left, torch.zeros(middle - start, rank, dtype=torch.float64).index_copy(0, rows1, U))
+            P2 = hodlr._solve_node(right, torch.zeros(stop - middle, rank, dtype=torch.float64).index_copy(0, rows2, V))
+            G1, G2 = U.T @ P1[rows1], V.T @ P2[rows2]
+            sign, log_det_capacitance = torch.linalg.slogdet(torch.eye(rank, dtype=torch.float64) - G1 @ G2)
+            if sign <= 0:
+                raise ValueError("HODLR approximation is not positive definite; lower tol.")
+            log_det += log_det_capacitance.item()
+
+            eye = torch.eye(rank, dtype=torch.float64)
+            capacitance = torch.cat([torch.cat([G1, eye], dim=1), torch.cat([eye, G2], dim=1)])
+            arrays[f"{k}_U"], arrays[f"{k}_V"] = U, V
+            arrays[f"{k}_rows1"], arrays[f"{k}_rows2"] = rows1, rows2
+            arrays[f"{k}_P1"], arrays[f"{k}_P2"] = P1, P2
+            arrays[f"{k}_capacitance_lu"], arrays[f"{k}_capacitance_pivots"] = torch.linalg.lu_factor(capacitance)
+
+        hodlr.log_det = log_det
+        return hodlr
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, tol=1e-6, leaf_size=256, pixel_scale=1.8):
+        """
+        HODLR form of the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        return cls.from_kernel(find_correlation_kernel(image_size, sigma, pixel_scale), tol, leaf_size)
+
+    @classmethod
+    def from_beam(cls, image_size, fwhm_major, fwhm_minor, tol=1e-6, leaf_size=256, pixel_scale=1.8,
+                  position_angle=0.0):
+        """
+        HODLR form of an elliptical beam covariance, as in find_beam_covariance_matrix.
+        """
+        kernel = find_beam_kernel(image_size, fwhm_major, fwhm_minor, pixel_scale, position_angle)
+        return cls.from_kernel(kernel, tol, leaf_size)
+
+    def _solve_node(self, k, b):
+        """
+        K_k^-1 b for the (n_k, batch) block b of node k.
+        """
+        left, right = self.nodes[k][2], self.nodes[k][3]
+        a = self.arrays
+        if left < 0:
+            return torch.cholesky_solve(b, a[f"{k}_leaf"])
+        n1 = self.nodes[left][1] - self.nodes[left][0]
+        y1, y2 = self._solve_node(left, b[:n1]), self._solve_node(right, b[n1:])
+        if f"{k}_U" not in a:
+            return torch.cat([y1, y2])  # Block-diagonal node
+        rank = a[f"{k}_U"].shape[1]
+        t = torch.cat([a[f"{k}_U"].T @ y1[a[f"{k}_rows1"]], a[f"{k}_V"].T @ y2[a[f"{k}_rows2"]]])
+        s = torch.linalg.lu_solve(a[f"{k}_capacitance_lu"], a[f"{k}_capacitance_pivots"], t)
+        return torch.cat([y1 - a[f"{k}_P1"] @ s[:rank], y2 - a[f"{k}_P2"] @ s[rank:]])
+
+    def solve(self, b):
+        """
+        Inputs:
+          - b: (batch, N) flattened (row-major) images.
+        Outputs:
+          - (batch, N) Sigma^-1 b.
+        """
+        order = self.arrays["order"]
+        x = self._solve_node(0, b[:, order].T).T
+        out = torch.empty_like(x)
+        out[:, order] = x
+        return out
+
+    def to(self, device=None, dtype=None):
+        """
+        Copy with the floating-point arrays moved to device and cast to dtype
+        (pivots and index arrays keep their integer type).
+        """
+        arrays = {
+            name: array.to(device=device, dtype=dtype if array.is_floating_point() else None)
+            for name, array in self.arrays.items()
+        }
+        return HODLRCovariance(arrays, self.log_det)
+
+    def nbytes(self):
+        """
+        Memory held by the representation, in bytes.
+        """
+        return sum(array.element_size() * array.numel() for array in self.arrays.values())
+
+    def to_arrays(self):
+        """
+        dict of name -> np.ndarray, including the float64 log_det, for np.savez or CovarianceCache.
+        """
+        arrays = {name: array.cpu().numpy() for name, array in self.arrays.items()}
+        arrays["log_det"] = np.float64(self.log_det)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Inverse of to_arrays (memory maps are copied into CPU tensors).
+        """
+        tensors = {name: torch.from_numpy(np.array(array)) for name, array in arrays.items() if name != "log_det"}
+        return cls(tensors, float(arrays["log_det"]))
+
+    def save(self, path):
+        """
+        Serialise to a single .npz file.
+        """
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a representation written by save, on the CPU in its stored dtype.
+        """
+        with np.load(path) as data:
+            return cls.from_arrays({name: data[name] for name in data.files})
+
+
+def cached_psf_hodlr(cache, image_size, sigma, tol=1e-6, leaf_size=256, pixel_scale=1.8):
+    """
+    HODLRCovariance.from_psf, built once in float64 and stored in a CovarianceCache.
+    """
+    arrays = cache.get_or_compute(
+        lambda: HODLRCovariance.from_psf(image_size, sigma, tol, leaf_size, pixel_scale).to_arrays(),
+        image_size=image_size, sigma=sigma, tol=tol, leaf_size=leaf_size, pixel_scale=pixel_scale, strategy="hodlr",
+    )
+    return HODLRCovariance.from_arrays(arrays)
@@ -0,0 +1,1157 @@
+import math
+
+import numpy as np
+import torch
+
+from covariance import (
+    FIRST_BEAMS,
+    banded_covariance_from_kernel,
+    covariance_block_from_kernel,
+    find_beam_kernel,
+    find_beam_kronecker_factors,
+    find_correlation_kernel,
+    find_kronecker_eigenpairs,
+    find_kronecker_factors,
+    find_sparse_correlation_matrix,
+    fit_precision_stencil,
+    precision_from_stencil,
+)
+
+
+class _GaussianNLL(torch.autograd.Function):
+    """
+    Fused Gaussian NLL for a fixed covariance Sigma = W^-1 W^-T, where W is the
+    whitening map of the engine. Only the whitened residual y = W (x - mu) is
+    saved, and the backward pass is the closed form
+        d nll / dx = Sigma^-1 (x - mu) = W^T y,  d nll / dmu = -d nll / dx
+    so none of the intermediates of the forward solve are kept for autograd.
+    The engine may whiten in a wider dtype than x (see PRECISION_POLICIES):
+    the NLL is returned in that dtype, and the gradients in the dtype of x.
+    """
+
+    @staticmethod
+    def forward(ctx, x, mu, engine):
+        y = engine.whiten(x - mu)
+        ctx.engine = engine
+        ctx.dtype = x.dtype
+        ctx.save_for_backward(y)
+        return 0.5 * ((y**2).sum(dim=1) + engine.log_det + y.shape[1] * np.log(2 * np.pi))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        y, = ctx.saved_tensors
+        grad = (grad_output[:, None] * ctx.engine.whiten_transpose(y)).to(ctx.dtype)
+        grad_x = grad if ctx.needs_input_grad[0] else None
+        grad_mu = -grad if ctx.needs_input_grad[1] else None
+        return grad_x, grad_mu, None
+
+
+def fused_nll(engine, x, mu):
+    """
+    Gaussian NLL with an analytic backward pass, for training. Same values as
+    engine.nll(x, mu), but autograd only keeps the (batch, d) whitened residual.
+    Inputs:
+      - engine: likelihood exposing whiten(z), whiten_transpose(y) and log_det
+        (CholeskyGaussian, KroneckerGaussian, BlockDiagonalGaussian, TileGaussian,
+        BandedGaussian, SparseCholeskyGaussian, VecchiaGaussian).
+      - x, mu: (batch, d) flattened images, of the same shape.
+    Outputs:
+      - (batch,) negative log-likelihoods.
+    """
+    return _GaussianNLL.apply(x, mu, engine)
+
+
+# Precision policies for the dense factor: name -> (storage dtype, solve dtype).
+# The factor is kept in the storage dtype and cast panel by panel to the solve
+# dtype, in which the residual is whitened and its squares summed. The
+# log-determinant is always precomputed in float64 from the float64 factorisation.
+# benchmark_likelihoods.precision_policy_report measures the NLL error of each.
+PRECISION_POLICIES = {
+    "float64": (torch.float64, torch.float64),
+    "float32": (torch.float32, torch.float32),
+    "float32/float64": (torch.float32, torch.float64),
+    "bfloat16/float32": (torch.bfloat16, torch.float32),
+    "bfloat16/float64": (torch.bfloat16, torch.float64),
+}
+
+
+class _GaussianEngine:
+    """
+    Gaussian NLL shared by the likelihood engines,
+        nll = 0.5 * (m + log|Sigma| + d log(2 pi)),  m = |W (x - mu)|^2
+    for a whitening map W. Subclasses set d and log_det (a float64 float) and
+    either define whiten or override mahalanobis with their own quadratic form.
+    """
+
+    def mahalanobis(self, x, mu):
+        """
+        Inputs:
+          - x, mu: (batch, d) flattened images.
+        Outputs:
+          - (batch,) squared Mahalanobis distances.
+        """
+        return (self.whiten(x - mu)**2).sum(dim=1)
+
+    def nll(self, x, mu):
+        """
+        Batch-wise negative log-likelihood.
+        """
+        return 0.5 * (self.mahalanobis(x, mu) + self.log_det + self.d * np.log(2 * np.pi))
+
+
+class CholeskyGaussian(_GaussianEngine):
+    """
+    Exact Gaussian NLL from a dense lower Cholesky factor, as used by options
+    1-3 through MultivariateNormal(scale_tril=...). Each call is one triangular
+    solve per batch.
+
+    With a compute_dtype different from the factor's dtype (e.g. a float32 or
+    bfloat16 factor solved in float64), the solve is done by blocked
+    substitution: each (block_size, d) panel of the factor is cast as it is
+    used, so the wider copy of the factor is never held in memory at once, and
+    the Mahalanobis distance and NLL are returned in compute_dtype.
+    """
+
+    def __init__(self, scale_tril, log_det=None, compute_dtype=None, block_size=1024):
+        """
+        Inputs:
+          - scale_tril: (d, d) lower Cholesky factor of the covariance.
+          - log_det: log-determinant of the covariance, if already known
+            (e.g. from shared_psf_factors); computed from scale_tril otherwise.
+          - compute_dtype: dtype of the solves and of the sum of squares
+            (default: the dtype of scale_tril).
+          - block_size: rows per panel of the blocked mixed-precision solve.
+        """
+        if log_det is None:
+            log_det = 2 * torch.log(torch.diagonal(scale_tril).double()).sum().item()
+        self.d = scale_tril.shape[0]
+        self.scale_tril = scale_tril
+        self.log_det = float(log_det)  # Kept in float64
+        self.compute_dtype = scale_tril.dtype if compute_dtype is None else compute_dtype
+        self.block_size = block_size
+
+    @classmethod
+    def with_policy(cls, scale_tril, log_det, policy, **kwargs):
+        """
+        Engine under one of PRECISION_POLICIES, storing scale_tril (ideally
+        float64, so that it is rounded only once) in the policy's storage dtype.
+        """
+        storage_dtype, compute_dtype = PRECISION_POLICIES[policy]
+        return cls(scale_tril.to(storage_dtype), log_det, compute_dtype=compute_dtype, **kwargs)
+
+    def _panel(self, rows, cols):
+        return self.scale_tril[rows, cols].to(self.compute_dtype)
+
+    def whiten(self, z):
+        """
+        L^-1 z for each row of a (batch, d) residual, in compute_dtype.
+        """
+        z = z.to(self.compute_dtype)
+        if self.scale_tril.dtype == self.compute_dtype:
+            return torch.linalg.solve_triangular(self.scale_tril.mT, z, upper=True, left=False)
+
+        # Forward substitution on y L^T = z, one block of columns at a time
+        blocks = []
+        for start in range(0, self.d, self.block_size):
+            stop = min(start + self.block_size, self.d)
+            rhs = z[:, start:stop]
+            if blocks:
+                rhs = rhs - torch.cat(blocks, dim=1) @ self._panel(slice(start, stop), slice(0, start)).mT
+            diagonal = self._panel(slice(start, stop), slice(start, stop))
+            blocks.append(torch.linalg.solve_triangular(diagonal.mT, rhs, upper=True, left=False))
+        return torch.cat(blocks, dim=1)
+
+    def whiten_transpose(self, y):
+        """
+        L^-T y for each row of a (batch, d) whitened residual, in compute_dtype.
+        """
+        y = y.to(self.compute_dtype)
+        if self.scale_tril.dtype == self.compute_dtype:
+            return torch.linalg.solve_triangular(self.scale_tril, y, upper=False, left=False)
+
+        # Backward substitution on x L = y, from the last block of columns
+        blocks = []
+        for start in reversed(range(0, self.d, self.block_size)):
+            stop = min(start + self.block_size, self.d)
+            rhs = y[:, start:stop]
+            if blocks:
+                rhs = rhs - torch.cat(blocks, dim=1) @ self._panel(slice(stop, self.d), slice(start, stop))
+            diagonal = self._panel(slice(start, stop), slice(start, stop))
+            blocks.insert(0, torch.linalg.solve_triangular(diagonal, rhs, upper=False, left=False))
+        return torch.cat(blocks, dim=1)
+
+
+class KroneckerGaussian(_GaussianEngine):
+    """
+    Exact Gaussian NLL for the covariance from find_correlation_matrix, using
+    the Kronecker structure of the PSF kernel instead of a dense Cholesky.
+
+    With A_rows = U diag(lam) U^T and A_cols = V diag(nu) V^T, the full matrix is
+        C = (U x V) (norm * lam_i * nu_j + (1 - norm)) (U x V)^T
+    so the diagonal override is only a shift of the Kronecker eigenvalues.
+    Setup is two (image_size, image_size) eigendecompositions and each call
+    costs two image_size^3 matrix products per image.
+    """
+
+    def __init__(self, image_size, sigma, pixel_scale=1.8, device=None, dtype=torch.float32):
+        norm, A = find_kronecker_factors(image_size, sigma, pixel_scale)
+        self._set_factors(norm, A, A, device, dtype)
+
+    @classmethod
+    def from_beam(cls, image_size, fwhm_major, fwhm_minor, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Exact NLL for an axis-aligned elliptical beam, as in find_beam_covariance_matrix.
+        """
+        engine = cls.__new__(cls)
+        norm, A_major, A_minor = find_beam_kronecker_factors(image_size, fwhm_major, fwhm_minor, pixel_scale)
+        engine._set_factors(norm, A_major, A_minor, device, dtype)
+        return engine
+
+    def _set_factors(self, norm, A_rows, A_cols, device, dtype):
+        lam, U = np.linalg.eigh(A_rows)
+        nu, V = np.linalg.eigh(A_cols)
+        eigenvalues = norm * np.outer(lam, nu) + (1 - norm)
+
+        self.image_size = A_rows.shape[0]
+        self.d = self.image_size**2
+        self.U = torch.tensor(U, dtype=dtype, device=device)
+        self.V = torch.tensor(V, dtype=dtype, device=device)
+        self.inv_sqrt_eigenvalues = torch.tensor(1 / np.sqrt(eigenvalues), dtype=dtype, device=device)
+        self.log_det = float(np.sum(np.log(eigenvalues)))  # Kept in float64
+
+    def whiten(self, z):
+        """
+        Residuals in the scaled Kronecker eigenbasis, D^-1/2 (U x V)^T z, as (batch, image_size**2).
+        """
+        z = z.reshape(-1, self.image_size, self.image_size)
+        w = self.U.T @ z @ self.V  # Coefficients in the Kronecker eigenbasis
+        return (w * self.inv_sqrt_eigenvalues).reshape(z.shape[0], -1)
+
+    def whiten_transpose(self, y):
+        """
+        (U x V) D^-1/2 y, the transpose of whiten.
+        """
+        y = y.reshape(-1, self.image_size, self.image_size) * self.inv_sqrt_eigenvalues
+        return (self.U @ y @ self.V.T).reshape(y.shape[0], -1)
+
+
+class WhittleGaussian(_GaussianEngine):
+    """
+    Fourier-domain (Whittle) approximation to the Gaussian NLL. The covariance
+    is replaced by its periodic version on the (n, n) torus, which is
+    diagonalised by the 2D DFT with eigenvalues S (the PSF power spectrum), so
+        (x-mu)^T C^-1 (x-mu) ~ sum_k |Z_k|^2 / (S_k n^2),  log|C| ~ sum_k log S_k
+    with Z = fft2(x-mu). Per batch this costs one rfft2 per image and the
+    log-determinant is a closed-form sum computed once.
+    """
+
+    def __init__(self, image_size, sigma, pixel_scale=1.8, device=None, dtype=torch.float32):
+        kernel = find_correlation_kernel(image_size, sigma, pixel_scale)
+
+        # Wrap the lag kernel onto the torus, lag -k and n-k being the same pixel
+        lags = np.arange(image_size)
+        lags = np.where(lags <= image_size // 2, lags, lags - image_size) + image_size - 1
+        periodic_kernel = kernel[np.ix_(lags, lags)]
+
+        spectrum = np.fft.fft2(periodic_kernel).real
+        if spectrum.min() <= 0:
+            raise ValueError("Periodic PSF spectrum is not positive; the Whittle likelihood is undefined.")
+
+        # rfft2 keeps half of the last axis; the dropped half mirrors the kept one
+        half_spectrum = np.fft.rfft2(periodic_kernel).real
+        weights = np.full(half_spectrum.shape, 2.0)
+        weights[:, 0] = 1
+        if image_size % 2 == 0:
+            weights[:, -1] = 1
+
+        self.image_size = image_size
+        self.d = image_size**2
+        self.inv_spectrum = torch.tensor(weights / (half_spectrum * image_size**2), dtype=dtype, device=device)
+        self.log_det = float(np.sum(np.log(spectrum)))  # Kept in float64
+
+    def mahalanobis(self, x, mu):
+        """
+        Inputs:
+          - x, mu: (batch, image_size**2) flattened images, row-major.
+        Outputs:
+          - (batch,) approximate squared Mahalanobis distances.
+        """
+        z = (x - mu).reshape(-1, self.image_size, self.image_size)
+        Z = torch.fft.rfft2(z)
+        return ((Z.real**2 + Z.imag**2) * self.inv_spectrum).sum(dim=(1, 2))
+
+
+class BlockDiagonalGaussian(_GaussianEngine):
+    """
+    Block-diagonal approximation of a covariance, as in option 4: consecutive
+    blocks of n pixels along the flattened image, plus a remainder block. The
+    lower Cholesky factors of the blocks are stacked and the total
+    log-determinant precomputed once, so each call is only one batched
+    triangular solve over (batch, num_blocks, n).
+
+    For a stationary covariance on an image of width W, block k only depends on
+    where it wraps across image rows, i.e. on (k * n) % W. That repeats every
+    W / gcd(n, W) blocks (25 for W=150, n=12), so when image_width is given
+    only one period of blocks is factorised, and the blocks are solved as
+    (batch, repeats, period, n) against the period's factors.
+    """
+
+    def __init__(self, cov, n, image_width=None, device=None, dtype=None):
+        """
+        Inputs:
+          - cov: (d, d) covariance matrix (torch tensor); only its diagonal blocks are read.
+          - n: block size.
+          - image_width: width of the (row-major) image, to share the factors of
+            identical blocks. Only valid if cov is stationary, which is checked
+            on the period after the first (ValueError otherwise).
+          - device, dtype: where and how the factors are stored (default: those of cov).
+        """
+        device = cov.device if device is None else device
+        dtype = cov.dtype if dtype is None else dtype
+        self._factorise(
+            lambda index: cov[index[..., :, None].to(cov.device), index[..., None, :].to(cov.device)],
+            cov.shape[0], n, image_width, device, dtype,
+        )
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, n, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Blocks of the covariance from find_correlation_matrix(image_size, sigma),
+        gathered from its lag kernel so the (N, N) matrix is never built.
+        """
+        kernel = find_correlation_kernel(image_size, sigma, pixel_scale)
+        engine = cls.__new__(cls)
+        engine._factorise(
+            lambda index: torch.from_numpy(covariance_block_from_kernel(kernel, index.numpy())),
+            image_size**2, n, image_size, device, dtype,
+        )
+        return engine
+
+    def _factorise(self, gather, d, n, image_width, device, dtype):
+        """
+        Factorise the blocks, where gather maps a (..., m) tensor of pixel
+        indices to the (..., m, m) covariance among them.
+        """
+        self.d = d
+        self.n = n
+        self.num_blocks = d // n
+        self.remainder = d % n
+
+        if image_width is None:
+            self.period = self.num_blocks
+        else:
+            self.period = min(image_width // math.gcd(n, image_width), self.num_blocks)
+        self.repeats = self.num_blocks // self.period  # Full periods of blocks
+        self.extra = self.num_blocks % self.period  # Blocks of a last, partial period
+
+        index = torch.arange(self.period * n).view(self.period, n)
+        blocks = gather(index).to(device=device, dtype=torch.float64)
+        if self.period < self.num_blocks:
+            # Blocks k and k + period must match for the factors to be shared
+            count = min(self.period, self.num_blocks - self.period)
+            shifted = gather(index[:count] + self.period * n).to(device=device, dtype=torch.float64)
+            if not torch.allclose(blocks[:count], shifted):
+                raise ValueError(
+                    f"Blocks {self.period} apart differ, so cov is not stationary on an image of width "
+                    f"{image_width}; pass image_width=None to factorise every block."
+                )
+        L = torch.linalg.cholesky(blocks)
+        block_log_dets = 2 * torch.log(torch.diagonal(L, dim1=-2, dim2=-1)).sum(dim=-1)
+        log_det = self.repeats * block_log_dets.sum() + block_log_dets[:self.extra].sum()
+        self.scale_tril = L.to(dtype)  # (period, n, n)
+
+        self.scale_tril_rem = None
+        if self.remainder > 0:
+            rem = gather(torch.arange(d - self.remainder, d))
+            L_rem = torch.linalg.cholesky(rem.to(device=device, dtype=torch.float64))
+            log_det = log_det + 2 * torch.log(torch.diagonal(L_rem)).sum()
+            self.scale_tril_rem = L_rem.to(dtype)
+
+        self.log_det = log_det.item()  # Kept in float64
+
+    def _solve_blocks(self, z, transpose=False):
+        """
+        L^-1 z (or L^-T z if transpose) block by block, for a (batch, d) z.
+        """
+        batch_size = z.shape[0]
+        n = self.n
+
+        def solve(L, b):
+            if transpose:
+                return torch.linalg.solve_triangular(L.mT, b, upper=True)
+            return torch.linalg.solve_triangular(L, b, upper=False)
+
+        periodic = self.repeats * self.period * n
+        z_blocks = z[:, :periodic].reshape(batch_size, self.repeats, self.period, n, 1)
+        out = [solve(self.scale_tril, z_blocks).reshape(batch_size, -1)]
+
+        if self.extra > 0:
+            z_extra = z[:, periodic:self.num_blocks * n].reshape(batch_size, self.extra, n, 1)
+            out.append(solve(self.scale_tril[:self.extra], z_extra).reshape(batch_size, -1))
+
+        if self.remainder > 0:
+            out.append(solve(self.scale_tril_rem, z[:, self.num_blocks * n:].T).T)
+        return torch.cat(out, dim=1)
+
+    def whiten(self, z):
+        """
+        L^-1 z for each row of a (batch, d) residual, L being the block-diagonal factor.
+        """
+        return self._solve_blocks(z)
+
+    def whiten_transpose(self, y):
+        """
+        L^-T y for each row of a (batch, d) whitened residual.
+        """
+        return self._solve_blocks(y, transpose=True)
+
+
+class TileGaussian(_GaussianEngine):
+    """
+    Block-diagonal approximation with square spatial tiles: the image is cut
+    into k x k tiles (with unfold) rather than into runs of the flattened image,
+    so each block keeps the correlations of a 2D neighbourhood instead of
+    cutting across image rows. The kernel is stationary, so all full tiles
+    share one factor; the right-edge, bottom-edge and corner tiles left over
+    when k does not divide the image size each have their own. Each call is one
+    batched solve over (batch, tiles, k^2) plus one per edge shape.
+    """
+
+    def __init__(self, kernel, k, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - kernel: (2n-1, 2n-1) lag kernel, as from find_correlation_kernel.
+          - k: tile size.
+          - device, dtype: where and how the factors are stored.
+        """
+        self.image_size = (kernel.shape[0] + 1) // 2
+        self.d = self.image_size**2
+        self.k = k
+        self.num_tiles = self.image_size // k  # Full tiles along each axis
+        self.edge = self.image_size % k
+
+        self._kernel = kernel
+        self._device = device
+        self._dtype = dtype
+        self._factors = {}  # (height, width) -> (lower factor, log-determinant)
+
+        full, edge, m = self.k, self.edge, self.num_tiles
+        log_det = m * m * self._factor(full, full)[1]
+        if edge > 0:
+            log_det += m * self._factor(full, edge)[1] + m * self._factor(edge, full)[1]
+            log_det += self._factor(edge, edge)[1]
+        self.log_det = log_det  # Kept in float64
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, k, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Tiles of the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        return cls(find_correlation_kernel(image_size, sigma, pixel_scale), k, device=device, dtype=dtype)
+
+    def _factor(self, height, width):
+        """
+        Cached lower Cholesky factor and log-determinant of a (height, width) tile.
+        """
+        if (height, width) not in self._factors:
+            rows, cols = np.meshgrid(np.arange(height), np.arange(width), indexing="ij")
+            rows, cols = rows.ravel(), cols.ravel()
+            centre = self.image_size - 1
+            cov = self._kernel[rows[:, None] - rows[None, :] + centre, cols[:, None] - cols[None, :] + centre]
+            L = np.linalg.cholesky(cov)
+            self._factors[(height, width)] = (
+                torch.tensor(L, dtype=self._dtype, device=self._device),
+                2 * np.sum(np.log(np.diag(L))),
+            )
+        return self._factors[(height, width)]
+
+    def _solve_tiles(self, z, transpose=False):
+        """
+        L^-1 z (or L^-T z if transpose) tile by tile, for (batch, image_size,
+        image_size) images. Each tile's result is written back in its place.
+        """
+        batch_size = z.shape[0]
+        full, edge = self.k, self.edge
+        inner = self.num_tiles * full
+        regions = [(slice(0, inner), slice(0, inner), full, full)]
+        if edge > 0:
+            regions += [
+                (slice(0, inner), slice(inner, None), full, edge),
+                (slice(inner, None), slice(0, inner), edge, full),
+                (slice(inner, None), slice(inner, None), edge, edge),
+            ]
+
+        out = torch.empty_like(z)
+        for rows, cols, height, width in regions:
+            region = z[:, rows, cols]
+            num_rows, num_cols = region.shape[1] // height, region.shape[2] // width
+            tiles = region.unfold(1, height, height).unfold(2, width, width)  # (batch, rows, cols, height, width)
+            tiles = tiles.reshape(batch_size, -1, height * width, 1)
+            L = self._factor(height, width)[0]
+            if transpose:
+                y = torch.linalg.solve_triangular(L.mT, tiles, upper=True)
+            else:
+                y = torch.linalg.solve_triangular(L, tiles, upper=False)
+            y = y.reshape(batch_size, num_rows, num_cols, height, width).permute(0, 1, 3, 2, 4)
+            out[:, rows, cols] = y.reshape(batch_size, num_rows * height, num_cols * width)
+        return out
+
+    def whiten(self, z):
+        """
+        L^-1 z for each row of a (batch, image_size**2) residual, L being the tiled factor.
+        """
+        z = z.reshape(-1, self.image_size, self.image_size)
+        return self._solve_tiles(z).reshape(z.shape[0], -1)
+
+    def whiten_transpose(self, y):
+        """
+        L^-T y for each row of a (batch, image_size**2) whitened residual.
+        """
+        y = y.reshape(-1, self.image_size, self.image_size)
+        return self._solve_tiles(y, transpose=True).reshape(y.shape[0], -1)
+
+
+class BandedGaussian(_GaussianEngine):
+    """
+    Banded approximation of a covariance, as sparse_bandwidth_mvg_nll in
+    covariance_matrix_simplifiers.ipynb: entries more than bandwidth apart in
+    the flattened image are dropped. The band is factorised once with
+    scipy.linalg.cholesky_banded, in O(N bw^2). Cut into bw x bw blocks, the
+    banded lower factor is block-bidiagonal, with lower-triangular diagonal
+    blocks D_k and upper-triangular subdiagonal blocks S_k, so
+        y_k = D_k^-1 (z_k - S_k y_{k-1})
+    solves it in N / bw batched torch steps, O(batch N bw) per call, with autograd.
+    """
+
+    def __init__(self, band, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - band: (bandwidth + 1, d) covariance in LAPACK lower band layout, as
+            from banded_covariance_from_kernel. Raises LinAlgError if the
+            banded matrix is not positive definite.
+          - device, dtype: where and how the factor blocks are stored.
+        """
+        from scipy.linalg import cholesky_banded
+
+        factor = cholesky_banded(band, lower=True)  # factor[k, q] = L[q + k, q]
+        b, d = band.shape[0] - 1, band.shape[1]
+        num_blocks = -(-d // b)
+
+        # Pad to whole blocks with a unit diagonal, which leaves the NLL unchanged
+        padded = np.zeros((b + 1, num_blocks * b))
+        padded[:, :d] = factor
+        padded[np.arange(b + 1)[:, None] + np.arange(num_blocks * b)[None, :] >= d] = 0
+        padded[0, d:] = 1
+
+        rows, cols = np.meshgrid(np.arange(b), np.arange(b), indexing="ij")
+        starts = b * np.arange(num_blocks)[:, None, None]
+        lower, upper = rows >= cols, rows <= cols
+        diag_blocks = np.where(lower, padded[np.where(lower, rows - cols, 0), starts + cols], 0)
+        sub_blocks = np.where(upper, padded[np.where(upper, b + rows - cols, 0), starts - b + cols], 0)
+        sub_blocks[0] = 0  # The first block has no predecessor
+
+        self.d = d
+        self.bandwidth = b
+        self.num_blocks = num_blocks
+        self.diag_blocks = torch.tensor(diag_blocks, dtype=dtype, device=device)  # (num_blocks, b, b)
+        self.sub_blocks = torch.tensor(sub_blocks, dtype=dtype, device=device)
+        self.log_det = float(2 * np.sum(np.log(factor[0])))  # Kept in float64
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, bandwidth, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Band of the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        kernel = find_correlation_kernel(image_size, sigma, pixel_scale)
+        return cls(banded_covariance_from_kernel(kernel, bandwidth), device=device, dtype=dtype)
+
+    def _blocks(self, z):
+        padding = self.num_blocks * self.bandwidth - self.d
+        return torch.nn.functional.pad(z, (0, padding)).reshape(z.shape[0], self.num_blocks, self.bandwidth, 1)
+
+    def whiten(self, z):
+        """
+        L^-1 z for each row of a (batch, d) residual, by forward block substitution.
+        """
+        z = self._blocks(z)
+        y = [torch.linalg.solve_triangular(self.diag_blocks[0], z[:, 0], upper=False)]
+        for k in range(1, self.num_blocks):
+            rhs = z[:, k] - self.sub_blocks[k] @ y[-1]
+            y.append(torch.linalg.solve_triangular(self.diag_blocks[k], rhs, upper=False))
+        return torch.cat(y, dim=1)[:, :self.d, 0]
+
+    def whiten_transpose(self, y):
+        """
+        L^-T y for each row of a (batch, d) whitened residual, by backward block substitution.
+        """
+        y = self._blocks(y)
+        last = self.num_blocks - 1
+        x = [torch.linalg.solve_triangular(self.diag_blocks[last].mT, y[:, last], upper=True)]
+        for k in range(last - 1, -1, -1):
+            rhs = y[:, k] - self.sub_blocks[k + 1].mT @ x[-1]
+            x.append(torch.linalg.solve_triangular(self.diag_blocks[k].mT, rhs, upper=True))
+        return torch.cat(x[::-1], dim=1)[:, :self.d, 0]
+
+
+class SparseCholeskyGaussian(_GaussianEngine):
+    """
+    Gaussian NLL for a truncated (sparse) covariance, as from
+    find_sparse_correlation_matrix, through a sparse Cholesky factor. Row-major
+    banding keeps a whole image row of bandwidth; here the pixels are first
+    reordered to reduce fill-in (SuperLU's minimum degree ordering on A + A^T
+    by default), so that P A P^T = L L^T stays sparse. SuperLU is run
+    without pivoting in symmetric mode, so its LU is L D L^T and the Cholesky
+    factor is L D^1/2. The factor is held as torch sparse CSR, and each call
+    is one sparse triangular solve over the batch. torch has no autograd for
+    sparse solves, so mahalanobis is not differentiable; nll goes through fused_nll.
+    """
+
+    def __init__(self, matrix, ordering="MMD_AT_PLUS_A", device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - matrix: (d, d) scipy sparse symmetric positive definite covariance.
+          - ordering: fill-reducing ordering, any scipy splu permc_spec
+            ("MMD_AT_PLUS_A", "COLAMD", "NATURAL", ...).
+          - device, dtype: where and how the factor is stored.
+        """
+        from scipy.sparse import diags
+        from scipy.sparse.linalg import splu
+
+        from psf_operator import sparse_to_torch
+
+        lu = splu(matrix.tocsc(), permc_spec=ordering, diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+        if not np.array_equal(lu.perm_r, lu.perm_c):
+            raise ValueError("SuperLU pivoted off the diagonal; the matrix is not positive definite enough.")
+        pivots = lu.U.diagonal()
+        if pivots.min() <= 0:
+            raise ValueError("Sparse covariance is not positive definite.")
+
+        L = lu.L @ diags(np.sqrt(pivots))
+        self.d = matrix.shape[0]
+        self.nnz = L.nnz
+        # SuperLU moves pixel k to position perm_c[k]; store the pixel at each position
+        self.order = torch.tensor(np.argsort(lu.perm_c), dtype=torch.int64, device=device)
+        self.scale_tril = sparse_to_torch(L, device=device, dtype=dtype)
+        self.log_det = float(np.sum(np.log(pivots)))  # Kept in float64
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, cutoff, pixel_scale=1.8, ordering="MMD_AT_PLUS_A",
+                 device=None, dtype=torch.float32):
+        """
+        Factor of find_sparse_correlation_matrix(image_size, sigma, cutoff).
+        """
+        matrix = find_sparse_correlation_matrix(image_size, sigma, cutoff, pixel_scale)
+        return cls(matrix, ordering=ordering, device=device, dtype=dtype)
+
+    def whiten(self, z):
+        """
+        L^-1 P z for each row of a (batch, d) residual.
+        """
+        z = z[:, self.order].T.contiguous()
+        return torch.triangular_solve(z, self.scale_tril, upper=False).solution.T
+
+    def whiten_transpose(self, y):
+        """
+        P^T L^-T y for each row of a (batch, d) whitened residual.
+        """
+        x = torch.triangular_solve(y.T.contiguous(), self.scale_tril, upper=False, transpose=True).solution.T
+        out = torch.empty_like(x)
+        out[:, self.order] = x
+        return out
+
+    def nll(self, x, mu):
+        """
+        Batch-wise negative log-likelihood, differentiable through fused_nll.
+        """
+        return fused_nll(self, x, mu)
+
+
+class GMRFGaussian(_GaussianEngine):
+    """
+    Gaussian Markov random field approximation: the precision Sigma^-1 is
+    replaced by a sparse stencil Q (fit_precision_stencil), so
+        (x-mu)^T Q (x-mu) = sum((x-mu) * conv2d(x-mu, stencil))
+    costs one small convolution per image, O(N r^2). log|Q| is computed once
+    from a sparse factorisation of the (N, N) precision matrix.
+    """
+
+    def __init__(self, stencil, image_size, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - stencil: (2r+1, 2r+1) symmetric precision stencil.
+          - image_size: side of the (row-major) images.
+          - device, dtype: where and how the stencil is stored.
+        """
+        from scipy.sparse.linalg import splu
+
+        lu = splu(
+            precision_from_stencil(stencil, image_size).tocsc(),
+            permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0, options=dict(SymmetricMode=True),
+        )
+        pivots = lu.U.diagonal()
+        if pivots.min() <= 0:
+            raise ValueError("Precision stencil is not positive definite on the image grid.")
+
+        self.image_size = image_size
+        self.d = image_size**2
+        self.radius = stencil.shape[0] // 2
+        self.stencil = torch.tensor(stencil, dtype=dtype, device=device)[None, None]
+        self.log_det = -float(np.sum(np.log(pivots)))  # log|Sigma| = -log|Q|, kept in float64
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, radius, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Stencil fitted to the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        stencil = fit_precision_stencil(find_correlation_kernel(image_size, sigma, pixel_scale), radius)
+        return cls(stencil, image_size, device=device, dtype=dtype)
+
+    def mahalanobis(self, x, mu):
+        """
+        Inputs:
+          - x, mu: (batch, image_size**2) flattened images, row-major.
+        Outputs:
+          - (batch,) squared Mahalanobis distances (x-mu)^T Q (x-mu).
+        """
+        z = (x - mu).reshape(-1, 1, self.image_size, self.image_size)
+        Qz = torch.nn.functional.conv2d(z, self.stencil, padding=self.radius)
+        return (z * Qz).sum(dim=(1, 2, 3))
+
+
+class LowRankGaussian(_GaussianEngine):
+    """
+    Low-rank-plus-diagonal approximation from the top k eigenpairs of the
+    covariance. The rest of the spectrum is replaced by a diagonal that keeps
+    the pixel variances exact:
+        Sigma ~ W W^T + D,  W = V diag(lam)^1/2,  D = diag(Sigma) - rowsum(W^2)
+    The NLL uses the Woodbury identity and the matrix determinant lemma with
+    the (k, k) capacitance K = I + W^T D^-1 W, which is factorised once, as in
+    torch's LowRankMultivariateNormal. Each call is O(batch N k).
+    """
+
+    def __init__(self, eigenvalues, eigenvectors, variance, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - eigenvalues: (k,) leading eigenvalues of the covariance.
+          - eigenvectors: (d, k) matching orthonormal eigenvectors.
+          - variance: (d,) diagonal of the covariance (or a scalar).
+          - device, dtype: where and how the factors are stored.
+        """
+        W = eigenvectors * np.sqrt(eigenvalues)
+        diag = np.broadcast_to(variance, (W.shape[0],)) - np.sum(W**2, axis=1)
+        if diag.min() <= 0:
+            raise ValueError("Eigenpairs leave a non-positive diagonal; are they the leading ones?")
+        capacitance = np.eye(W.shape[1]) + (W.T / diag) @ W
+        L = np.linalg.cholesky(capacitance)
+
+        self.d, self.rank = W.shape
+        self.cov_factor = torch.tensor(W, dtype=dtype, device=device)
+        self.inv_diag = torch.tensor(1 / diag, dtype=dtype, device=device)
+        self.capacitance_tril = torch.tensor(L, dtype=dtype, device=device)
+        self.log_det = float(np.sum(np.log(diag)) + 2 * np.sum(np.log(np.diag(L))))  # Kept in float64
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, rank, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Top-rank eigenpairs of find_correlation_matrix(image_size, sigma), which has unit variance.
+        """
+        eigenvalues, eigenvectors = find_kronecker_eigenpairs(image_size, sigma, rank, pixel_scale)
+        return cls(eigenvalues, eigenvectors, 1.0, device=device, dtype=dtype)
+
+    @classmethod
+    def from_beam(cls, image_size, fwhm_major, fwhm_minor, rank, pixel_scale=1.8, position_angle=0.0,
+                  device=None, dtype=torch.float32):
+        """
+        Top-rank eigenpairs of an elliptical beam covariance (find_beam_covariance_matrix),
+        from the matrix-free Lanczos solver in spectral.py.
+        """
+        from psf_operator import PSFCovarianceOperator
+        from spectral import leading_eigenpairs
+
+        operator = PSFCovarianceOperator.from_beam(
+            image_size, fwhm_major, fwhm_minor, pixel_scale, position_angle, dtype=torch.float64
+        )
+        eigenvalues, eigenvectors = leading_eigenpairs(operator, rank)
+        return cls(eigenvalues, eigenvectors, 1.0, device=device, dtype=dtype)
+
+    def mahalanobis(self, x, mu):
+        """
+        Inputs:
+          - x, mu: (batch, d) flattened images.
+        Outputs:
+          - (batch,) squared Mahalanobis distances,
+            z^T D^-1 z - |L_K^-1 W^T D^-1 z|^2 by Woodbury.
+        """
+        z = x - mu
+        z_scaled = z * self.inv_diag
+        t = z_scaled @ self.cov_factor  # (batch, k)
+        s = torch.linalg.solve_triangular(self.capacitance_tril.mT, t, upper=True, left=False)
+        return (z * z_scaled).sum(dim=1) - (s**2).sum(dim=1)
+
+
+class VecchiaGaussian(_GaussianEngine):
+    """
+    Vecchia approximation: in raster order, each pixel is conditioned only on
+    its m nearest previously ordered pixels, so
+        -log p(z) = sum_p [ (z_p - w_p^T z_N(p))^2 / v_p + log v_p ] / 2 + const
+    with kriging weights w_p and conditional variances v_p from the kernel.
+    Equivalently Sigma^-1 ~ (I - B)^T V^-1 (I - B) with B strictly lower
+    triangular, m entries per row, so each call is one gather, O(batch N m).
+
+    The kernel is stationary, so the conditioning offsets and weights of a
+    pixel only depend on how close it is to the top, left and right edges
+    (clipped at m); the m x m kriging systems are solved once per such class,
+    and all interior pixels share one set of weights.
+    """
+
+    def __init__(self, kernel, m, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - kernel: (2n-1, 2n-1) lag kernel, as from find_correlation_kernel.
+          - m: number of conditioning pixels.
+          - device, dtype: where and how the weights are stored.
+        """
+        n = (kernel.shape[0] + 1) // 2
+        centre = n - 1
+        i, j = np.divmod(np.arange(n * n), n)
+        classes = np.stack([np.minimum(i, m), np.minimum(j, m), np.minimum(n - 1 - j, m)], axis=1)
+        unique, pixel_class = np.unique(classes, axis=0, return_inverse=True)
+        pixel_class = pixel_class.ravel()
+
+        # Previously ordered offsets within the window that holds the m nearest
+        di, dj = np.meshgrid(np.arange(-m, 1), np.arange(-m, m + 1), indexing="ij")
+        di, dj = di.ravel(), dj.ravel()
+        before = (di < 0) | (dj < 0)
+        di, dj = di[before], dj[before]
+        order = np.lexsort((dj, di, di**2 + dj**2))
+        di, dj = di[order], dj[order]
+
+        class_offsets = np.zeros((len(unique), m), dtype=np.int64)
+        class_weights = np.zeros((len(unique), m))
+        class_variance = np.empty(len(unique))
+        for c, (top, left, right) in enumerate(unique):
+            valid = (di >= -top) & (dj >= -left) & (dj <= right)
+            ni, nj = di[valid][:m], dj[valid][:m]
+            covariance = kernel[ni[:, None] - ni[None, :] + centre, nj[:, None] - nj[None, :] + centre]
+            cross = kernel[ni + centre, nj + centre]
+            weights = np.linalg.solve(covariance, cross) if len(ni) > 0 else np.zeros(0)
+            class_offsets[c, :len(ni)] = ni * n + nj
+            class_weights[c, :len(ni)] = weights
+            class_variance[c] = kernel[centre, centre] - cross @ weights
+
+        neighbours = np.arange(n * n)[:, None] + class_offsets[pixel_class]
+        weights = class_weights[pixel_class]
+        neighbours[weights == 0] = 0  # Padding slots of pixels with fewer than m predecessors
+        variance = class_variance[pixel_class]
+
+        self.d = n * n
+        self.m = m
+        self.num_classes = len(unique)
+        self.neighbours = torch.tensor(neighbours, dtype=torch.int64, device=device)  # (d, m)
+        self.weights = torch.tensor(weights, dtype=dtype, device=device)
+        self.inv_sqrt_variance = torch.tensor(1 / np.sqrt(variance), dtype=dtype, device=device)
+        self.log_det = float(np.sum(np.log(variance)))  # Kept in float64
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, m, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Vecchia approximation of the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        return cls(find_correlation_kernel(image_size, sigma, pixel_scale), m, device=device, dtype=dtype)
+
+    @classmethod
+    def from_beam(cls, image_size, fwhm_major, fwhm_minor, m, pixel_scale=1.8, position_angle=0.0,
+                  device=None, dtype=torch.float32):
+        """
+        Vecchia approximation for an elliptical beam, as in find_beam_covariance_matrix.
+        """
+        kernel = find_beam_kernel(image_size, fwhm_major, fwhm_minor, pixel_scale, position_angle)
+        return cls(kernel, m, device=device, dtype=dtype)
+
+    def whiten(self, z):
+        """
+        V^-1/2 (I - B) z for each row of a (batch, d) residual.
+        """
+        prediction = (z[:, self.neighbours] * self.weights).sum(dim=-1)
+        return (z - prediction) * self.inv_sqrt_variance
+
+    def whiten_transpose(self, y):
+        """
+        (I - B)^T V^-1/2 y for each row of a (batch, d) whitened residual.
+        """
+        y = y * self.inv_sqrt_variance
+        spread = -(y[:, :, None] * self.weights).reshape(y.shape[0], -1)
+        index = self.neighbours.reshape(1, -1).expand(y.shape[0], -1)
+        return y.scatter_add(1, index, spread)
+
+
+class _PCGSolve(torch.autograd.Function):
+    """
+    Sigma^-1 b by PCG, with an implicit-differentiation backward pass: Sigma
+    is symmetric, so the gradient is another solve, Sigma^-1 grad, and autograd
+    never unrolls the iterations. The backward solve is warm-started from the
+    forward solution, which is already its answer for the Mahalanobis term.
+    """
+
+    @staticmethod
+    def forward(ctx, b, engine):
+        u = engine._pcg(b, engine._warm_start(b))
+        ctx.engine = engine
+        ctx.save_for_backward(u)
+        return u
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        u, = ctx.saved_tensors
+        return ctx.engine._pcg(grad_output, u), None
+
+
+class PCGGaussian(_GaussianEngine):
+    """
+    Near-exact Gaussian NLL without any N x N factor: Sigma^-1 (x - mu) is
+    found by batched preconditioned conjugate gradients, with matvecs from
+    PSFCovarianceOperator (O(N log N) each) and a block-diagonal engine
+    (TileGaussian by default) as preconditioner, M^-1 = L^-T L^-1.
+
+    Each solve is warm-started from x0 scaled by the A-norm optimal
+        alpha = x0^T b / x0^T Sigma x0
+    which is never worse than starting from zero. x0 is the previous call's
+    solution when the batch shape matches. The log-determinant is computed
+    once (exactly for the PSF, or by StochasticLogDet for other beams).
+    """
+
+    def __init__(self, operator, preconditioner, log_det, tol=1e-5, max_iter=100, warm_start=True):
+        """
+        Inputs:
+          - operator: PSFCovarianceOperator of the covariance.
+          - preconditioner: engine with whiten and whiten_transpose (e.g.
+            TileGaussian, BlockDiagonalGaussian) approximating the covariance.
+          - log_det: log-determinant of the covariance.
+          - tol: relative residual at which each image's solve stops.
+          - max_iter: iteration cap per solve.
+          - warm_start: reuse the previous solution as the starting guess.
+        """
+        self.operator = operator
+        self.preconditioner = preconditioner
+        self.log_det = float(log_det)
+        self.d = operator.shape[0]
+        self.tol = tol
+        self.max_iter = max_iter
+        self.warm_start = warm_start
+        self.iterations = 0  # Iterations of the last solve, for monitoring
+        self._previous = None
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, tile_size=12, pixel_scale=1.8, device=None, dtype=torch.float32, **kwargs):
+        """
+        PCG for the covariance from find_correlation_matrix(image_size, sigma),
+        with tile_size tiles as preconditioner and the exact Kronecker log-determinant.
+        """
+        from psf_operator import PSFCovarianceOperator
+
+        operator = PSFCovarianceOperator.from_psf(image_size, sigma, pixel_scale, device=device, dtype=dtype)
+        preconditioner = TileGaussian.from_psf(image_size, sigma, tile_size, pixel_scale, device=device, dtype=dtype)
+        log_det = KroneckerGaussian(image_size, sigma, pixel_scale).log_det
+        return cls(operator, preconditioner, log_det, **kwargs)
+
+    @classmethod
+    def from_beam(cls, image_size, fwhm_major, fwhm_minor, tile_size=12, pixel_scale=1.8, position_angle=0.0,
+                  num_probes=64, device=None, dtype=torch.float32, **kwargs):
+        """
+        PCG for an elliptical beam (find_beam_covariance_matrix). The
+        log-determinant is a StochasticLogDet estimate with num_probes probes.
+        """
+        from psf_operator import PSFCovarianceOperator
+        from spectral import StochasticLogDet
+
+        kernel = find_beam_kernel(image_size, fwhm_major, fwhm_minor, pixel_scale, position_angle)
+        operator = PSFCovarianceOperator(kernel, device=device, dtype=dtype)
+        preconditioner = TileGaussian(kernel, tile_size, device=device, dtype=dtype)
+        with torch.no_grad():
+            exact_operator = PSFCovarianceOperator(kernel, device=device, dtype=torch.float64)
+            log_det = StochasticLogDet(image_size**2, num_probes, device=device)(exact_operator.matvec).item()
+        return cls(operator, preconditioner, log_det, **kwargs)
+
+    def _warm_start(self, b):
+        if self.warm_start and self._previous is not None and self._previous.shape == b.shape:
+            return self._previous
+        return None
+
+    def _precondition(self, r):
+        return self.preconditioner.whiten_transpose(self.preconditioner.whiten(r))
+
+    def _pcg(self, b, x0=None):
+        """
+        Sigma^-1 b for each row of a (batch, d) b, starting from x0 if given.
+        """
+        if x0 is None:
+            x = torch.zeros_like(b)
+            r = b.clone()
+        else:
+            A_x0 = self.operator._apply(x0)
+            curvature = (x0 * A_x0).sum(dim=1)
+            alpha = torch.where(curvature > 0, (x0 * b).sum(dim=1) / curvature, torch.zeros_like(curvature))
+            x = alpha[:, None] * x0
+            r = b - alpha[:, None] * A_x0
+
+        threshold = self.tol * b.norm(dim=1)
+        z = self._precondition(r)
+        p = z
+        rz = (r * z).sum(dim=1)
+        for iteration in range(self.max_iter):
+            if (r.norm(dim=1) <= threshold).all():
+                break
+            Ap = self.operator._apply(p)
+            pAp = (p * Ap).sum(dim=1)
+            alpha = torch.where(pAp > 0, rz / pAp, torch.zeros_like(pAp))
+            x = x + alpha[:, None] * p
+            r = r - alpha[:, None] * Ap
+            z = self._precondition(r)
+            rz_new = (r * z).sum(dim=1)
+            beta = torch.where(rz > 0, rz_new / rz, torch.zeros_like(rz))
+            p = z + beta[:, None] * p
+            rz = rz_new
+        else:
+            iteration = self.max_iter
+        self.iterations = iteration
+        return x
+
+    def solve(self, b):
+        """
+        Inputs:
+          - b: (batch, d) right-hand sides.
+        Outputs:
+          - (batch, d) Sigma^-1 b, differentiable in b by implicit differentiation.
+        """
+        u = _PCGSolve.apply(b, self)
+        self._previous = u.detach()
+        return u
+
+    def mahalanobis(self, x, mu):
+        """
+        Inputs:
+          - x, mu: (batch, d) flattened images.
+        Outputs:
+          - (batch,) squared Mahalanobis distances, to the PCG tolerance.
+        """
+        z = x - mu
+        return (z * self.solve(z)).sum(dim=1)
+
+
+class _HODLRSolve(torch.autograd.Function):
+    """
+    Sigma^-1 b through a HODLR factorisation. Sigma is symmetric, so the
+    backward pass is one more solve and none of the recursion is saved.
+    """
+
+    @staticmethod
+    def forward(ctx, b, hodlr):
+        ctx.hodlr = hodlr
+        return hodlr.solve(b)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return ctx.hodlr.solve(grad_output), None
+
+
+class HODLRGaussian(_GaussianEngine):
+    """
+    Near-exact Gaussian NLL from a hierarchical (HODLR) factorisation of the
+    full covariance (see hodlr.HODLRCovariance): solves cost O(N r log N) and
+    the log-determinant is computed once in float64 at setup, with memory
+    O(N r log N) instead of O(N^2). The accuracy is set by tol when the
+    factorisation is built.
+    """
+
+    def __init__(self, hodlr, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - hodlr: HODLRCovariance, e.g. from HODLRCovariance.from_psf or cached_psf_hodlr.
+          - device, dtype: where and how its factors are stored.
+        """
+        self.hodlr = hodlr.to(device=device, dtype=dtype)
+        self.log_det = hodlr.log_det
+        self.d = hodlr.d
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, tol=1e-6, leaf_size=256, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        HODLR engine for the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        from hodlr import HODLRCovariance
+
+        return cls(HODLRCovariance.from_psf(image_size, sigma, tol, leaf_size, pixel_scale), device, dtype)
+
+    @classmethod
+    def from_beam(cls, image_size, fwhm_major, fwhm_minor, tol=1e-6, leaf_size=256, pixel_scale=1.8,
+                  position_angle=0.0, device=None, dtype=torch.float32):
+        """
+        HODLR engine for an elliptical beam, as in find_beam_covariance_matrix.
+        """
+        from hodlr import HODLRCovariance
+
+        hodlr = HODLRCovariance.from_beam(image_size, fwhm_major, fwhm_minor, tol, leaf_size, pixel_scale,
+                                          position_angle)
+        return cls(hodlr, device, dtype)
+
+    def mahalanobis(self, x, mu):
+        """
+        Inputs:
+          - x, mu: (batch, d) flattened images.
+        Outputs:
+          - (batch,) squared Mahalanobis distances.
+        """
+        z = x - mu
+        return (z * _HODLRSolve.apply(z, self.hodlr)).sum(dim=1)
+
+
+class PSFRegimeGaussian:
+    """
+    Gaussian NLL where each image uses the PSF of its own beam regime (see
+    FIRST_BEAMS and find_beam_regime). One engine is held per regime, and each
+    batch is regrouped by regime so that every engine still sees a batched call.
+    """
+
+    def __init__(self, engines):
+        """
+        Inputs:
+          - engines: list of likelihood engines (anything with nll(x, mu)), one per regime.
+        """
+        self.engines = engines
+
+    @classmethod
+    def first_beams(cls, image_size, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Exact Kronecker engines for the three FIRST beams. The circular
+        northern beam (regime 0) is the covariance of find_correlation_matrix,
+        as in options 3 and 5, whose kernel is normalised by 1/sqrt(2 pi sigma^2).
+        The elliptical beams have no such form and use find_beam_covariance_matrix,
+        normalised by 1/(2 pi sigma_major sigma_minor), so their off-diagonal
+        correlations are about 6x weaker than regime 0's.
+        """
+        engines = []
+        for beam in FIRST_BEAMS:
+            if beam["fwhm_major"] == beam["fwhm_minor"]:
+                sigma = beam["fwhm_major"] / (2 * np.sqrt(2 * np.log(2)))
+                engines.append(KroneckerGaussian(image_size, sigma, pixel_scale, device=device, dtype=dtype))
+            else:
+                engines.append(
+                    KroneckerGaussian.from_beam(image_size, pixel_scale=pixel_scale, device=device, dtype=dtype, **beam)
+                )
+        return cls(engines)
+
+    def nll(self, x, mu, regime):
+        """
+        Inputs:
+          - x, mu: (batch, image_size**2) flattened images, row-major.
+          - regime: (batch,) integer tensor (or array) of regime indices, on any device.
+        Outputs:
+          - (batch,) negative log-likelihoods, in the input order.
+        """
+        regime = torch.as_tensor(regime, device=x.device)
+        out = x.new_zeros(x.shape[0])
+        for r, engine in enumerate(self.engines):
+            index = torch.nonzero(regime == r, as_tuple=True)[0]
+            if len(index) > 0:
+                out = out.index_copy(0, index, engine.nll(x[index], mu[index]).to(out.dtype))
+        return out
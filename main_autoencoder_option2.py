@@ -1,4 +1,6 @@
 import os
+import signal
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
@@ -12,7 +14,9 @@ from torch.distributions import Normal, MultivariateNormal
 from encoder import Encoder
 from decoder import Decoder
 import plotting_functions
-from NLL_block_diag import mvg_nll_block
+from NLL_block_diag import mvg_nll_block_batched
+from likelihoods import CholeskyGaussian, fused_nll
+from shared_factors import shared_psf_factors
 
 option = 2
 # option 1: Identity matrix, option 2: 1/9 of the matrix, option 3: Full matrix, option 4: Block diag
@@ -30,25 +34,6 @@ class MemoryMappedDataset(Dataset):
         return torch.tensor(self.data[idx], dtype=torch.float32)
 
 
-def find_correlation_matrix(image_size, sigma):
-    """
-    Create a pixel-to-pixel correlation matrix for a square image.
-    Inputs:
-      - image_size: height/width of the image
-      - sigma: standard deviation used in the Gaussian correlation.
-    """
-    x, y = np.meshgrid(np.arange(image_size), np.arange(image_size), indexing="ij")
-    pixel_coords = np.stack((x.ravel(), y.ravel()), axis=1)
-    i, j = pixel_coords[:, 0], pixel_coords[:, 1]
-
-    di = i[:, None] - i[None, :]  # Difference in x for all pairs
-    dj = j[:, None] - j[None, :]  # Difference in y for all pairs
-    d = 1.8 * np.sqrt(di**2 + dj**2)  # Scaled Euclidean distances
-
-    C = (1 / np.sqrt(2 * np.pi * sigma**2)) * np.exp(-d**2 / (2 * sigma**2))
-    np.fill_diagonal(C, 1)  # Set diagonal to 1
-    return C
-
 # Data loading paths
 train_data_path = '/share/nas2_3/amahmoud/week5/galaxy_out/train_data.npy'
 valid_data_path = '/share/nas2_3/amahmoud/week5/galaxy_out/valid_data_original.npy'
@@ -84,6 +69,8 @@ learning_rate = 2e-4
 num_training_updates = 1000
 sigma = 5.4 / (2 * np.sqrt(2 * np.log(2)))
 image_size = 150
+# Factors are reused across launches from here
+cache_directory = '/share/nas2_3/adey/astro/covariance_cache/'
 
 wandb.init(
     project="Covariance_Estimation",
@@ -104,9 +91,13 @@ iteration = 0
 autoencoder.train()
 
 #print('Getting Covariance Matrix & Cholesky Component...')
-correlation_matrix = find_correlation_matrix(image_size, sigma)
-correlation_matrix = torch.from_numpy(correlation_matrix).float().to(device)
-scale_tril = torch.linalg.cholesky(correlation_matrix)
+# SIGTERM (e.g. from the scheduler) exits through atexit, which releases the shared factors
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+# Built once per node and shared with the other option scripts running alongside
+shared_factors = shared_psf_factors(image_size, sigma, cache_directory)
+correlation_matrix = shared_factors.tensors["correlation_matrix"].to(device)
+scale_tril = shared_factors.tensors["scale_tril"].to(device)
+full_gaussian = CholeskyGaussian(scale_tril, log_det=shared_factors.tensors["log_det"].item())
 
 # Compute the corresponding indices in the flattened representation
 h_indices = torch.arange(0, image_size, step=3, device=device)
@@ -117,6 +108,7 @@ subset_indices = (grid_h * image_size + grid_w).flatten()  # 1D indices
 # Compute subset covariance matrix only ONCE
 cov_subset = correlation_matrix[subset_indices][:, subset_indices].clone()
 scale_tril_subset = torch.linalg.cholesky(cov_subset)
+subset_gaussian = CholeskyGaussian(scale_tril_subset)
 
 
 print("Starting training...")
@@ -163,8 +155,7 @@ while iteration < num_training_updates:
             recon_flat_subset = recon_flat[:, subset_indices]
 
             # Use precomputed Cholesky factor for covariance matrix
-            mvn = MultivariateNormal(loc=recon_flat_subset, scale_tril=scale_tril_subset)
-            loss = -mvn.log_prob(images_flat_subset).sum()
+            loss = fused_nll(subset_gaussian, images_flat_subset, recon_flat_subset).sum()
 
             # Normalization
             D_total = images_flat_subset.size(0) * images_flat_subset.size(1)
@@ -173,8 +164,8 @@ while iteration < num_training_updates:
 
         # --- Full matrix calculation ---
         elif option == 3:
-            mvn = MultivariateNormal(loc=recon_flat, scale_tril=scale_tril)
-            loss = -mvn.log_prob(images_flat).sum()
+            # Fused NLL: autograd keeps only the whitened residual
+            loss = fused_nll(full_gaussian, images_flat, recon_flat).sum()
             # Malahanobis distance
             D_total = images_flat.size(0) * images_flat.size(1)  
             # Mean Reduction.
@@ -182,7 +173,7 @@ while iteration < num_training_updates:
 
         elif option == 4:
             # Block diagonal calculation
-            loss = mvg_nll_block(correlation_matrix, images_flat, recon_flat, 150)
+            loss = mvg_nll_block_batched(correlation_matrix, images_flat, recon_flat, 150).sum()
             # Mean reduction
             D_total = images_flat.size(0) * images_flat.size(1)
             loss_mean = loss/D_total
@@ -304,4 +295,5 @@ model_save_path = os.path.join(save_directory, 'autoencoder_model.pth')
 torch.save(autoencoder.state_dict(), model_save_path)
 print("Model saved to", model_save_path)
 
+shared_factors.close()
 wandb.finish()
@@ -1,4 +1,6 @@
 import os
+import signal
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
@@ -12,10 +14,33 @@ from torch.distributions import Normal, MultivariateNormal
 from encoder import Encoder
 from decoder import Decoder
 import plotting_functions
-from NLL_block_diag import mvg_nll_block
+from NLL_block_diag import mvg_nll_block_batched
+from covariance import find_cutoff_distance
+from covariance_cache import CovarianceCache
+from hodlr import cached_psf_hodlr
+from likelihoods import (
+    CholeskyGaussian,
+    GMRFGaussian,
+    HODLRGaussian,
+    KroneckerGaussian,
+    LowRankGaussian,
+    PCGGaussian,
+    PRECISION_POLICIES,
+    SparseCholeskyGaussian,
+    WhittleGaussian,
+    fused_nll,
+)
+from shared_factors import shared_psf_factors
 
 option = 3
 # option 1: Identity matrix, option 2: 1/9 of the matrix, option 3: Full matrix, option 4: Block diag
+# option 5: Full matrix via its Kronecker eigenbasis (exact, no dense Cholesky)
+# option 6: Fourier-domain (Whittle) approximation of the full matrix
+# option 9: Full matrix truncated at the 99.99% distance, sparse Cholesky with fill-reducing ordering
+# option 10: Sparse precision (GMRF) stencil fitted to the full matrix
+# option 11: Top-k eigenpairs of the full matrix plus a diagonal (low rank)
+# option 12: Full matrix by preconditioned conjugate gradients on FFT matvecs (no N x N factor)
+# option 14: Full matrix in hierarchical (HODLR) form, built once and cached on disk
 
 class MemoryMappedDataset(Dataset):
     def __init__(self, mmap_data, device):
@@ -30,25 +55,6 @@ class MemoryMappedDataset(Dataset):
         return torch.tensor(self.data[idx], dtype=torch.float32)
 
 
-def find_correlation_matrix(image_size, sigma):
-    """
-    Create a pixel-to-pixel correlation matrix for a square image.
-    Inputs:
-      - image_size: height/width of the image
-      - sigma: standard deviation used in the Gaussian correlation.
-    """
-    x, y = np.meshgrid(np.arange(image_size), np.arange(image_size), indexing="ij")
-    pixel_coords = np.stack((x.ravel(), y.ravel()), axis=1)
-    i, j = pixel_coords[:, 0], pixel_coords[:, 1]
-
-    di = i[:, None] - i[None, :]  # Difference in x for all pairs
-    dj = j[:, None] - j[None, :]  # Difference in y for all pairs
-    d = 1.8 * np.sqrt(di**2 + dj**2)  # Scaled Euclidean distances
-
-    C = (1 / np.sqrt(2 * np.pi * sigma**2)) * np.exp(-d**2 / (2 * sigma**2))
-    np.fill_diagonal(C, 1)  # Set diagonal to 1
-    return C
-
 # Data loading paths
 train_data_path = '/share/nas2_3/amahmoud/week5/galaxy_out/train_data.npy'
 valid_data_path = '/share/nas2_3/amahmoud/week5/galaxy_out/valid_data_original.npy'
@@ -84,6 +90,10 @@ learning_rate = 2e-4
 num_training_updates = 1000
 sigma = 5.4 / (2 * np.sqrt(2 * np.log(2)))
 image_size = 150
+# Factors are reused across launches from here
+cache_directory = '/share/nas2_3/adey/astro/covariance_cache/'
+# Storage/solve dtypes of the option 3 factor, see likelihoods.PRECISION_POLICIES
+precision_policy = "float32"
 
 wandb.init(
     project="Covariance_Estimation",
@@ -104,9 +114,40 @@ iteration = 0
 autoencoder.train()
 
 #print('Getting Covariance Matrix & Cholesky Component...')
-correlation_matrix = find_correlation_matrix(image_size, sigma)
-correlation_matrix = torch.from_numpy(correlation_matrix).float().to(device)
-scale_tril = torch.linalg.cholesky(correlation_matrix)
+if option == 5:
+    kronecker_gaussian = KroneckerGaussian(image_size, sigma, device=device)
+elif option == 6:
+    whittle_gaussian = WhittleGaussian(image_size, sigma, device=device)
+elif option == 9:
+    cutoff = find_cutoff_distance(0.9999, sigma)
+    sparse_gaussian = SparseCholeskyGaussian.from_psf(image_size, sigma, cutoff, device=device)
+elif option == 10:
+    # 7x7 precision stencil
+    gmrf_gaussian = GMRFGaussian.from_psf(image_size, sigma, 3, device=device)
+elif option == 11:
+    rank = 1000
+    low_rank_gaussian = LowRankGaussian.from_psf(image_size, sigma, rank, device=device)
+elif option == 12:
+    # 12x12 tile factors as preconditioner
+    pcg_gaussian = PCGGaussian.from_psf(image_size, sigma, tile_size=12, device=device)
+elif option == 14:
+    hodlr = cached_psf_hodlr(CovarianceCache(cache_directory), image_size, sigma, tol=1e-6)
+    hodlr_gaussian = HODLRGaussian(hodlr, device=device)
+else:
+    # SIGTERM (e.g. from the scheduler) exits through atexit, which releases the shared factors
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    # Built once per node and shared with the other option scripts running alongside
+    # The float64 policy needs a float64 factor; the others store float32 or
+    # bfloat16, cast from the float32 factor (rounded from float64 once)
+    factor_dtype = np.float32
+    if option == 3 and PRECISION_POLICIES[precision_policy][0] == torch.float64:
+        factor_dtype = np.float64
+    shared_factors = shared_psf_factors(image_size, sigma, cache_directory, dtype=factor_dtype)
+    correlation_matrix = shared_factors.tensors["correlation_matrix"].to(device)
+    scale_tril = shared_factors.tensors["scale_tril"].to(device)
+    full_gaussian = CholeskyGaussian.with_policy(
+        scale_tril, shared_factors.tensors["log_det"].item(), precision_policy
+    )
 
 print("Starting training...")
 while iteration < num_training_updates:
@@ -173,8 +214,8 @@ while iteration < num_training_updates:
 
         # --- Full matrix calculation ---
         elif option == 3:
-            mvn = MultivariateNormal(loc=recon_flat, scale_tril=scale_tril)
-            loss = -mvn.log_prob(images_flat).sum()
+            # Fused NLL: autograd keeps only the whitened residual
+            loss = fused_nll(full_gaussian, images_flat, recon_flat).sum()
             # Malahanobis distance
             D_total = images_flat.size(0) * images_flat.size(1)  
             # Mean Reduction.
@@ -182,13 +223,55 @@ while iteration < num_training_updates:
 
         elif option == 4:
             # Block diagonal calculation
-            loss = mvg_nll_block(correlation_matrix, images_flat, recon_flat, 150)
+            loss = mvg_nll_block_batched(correlation_matrix, images_flat, recon_flat, 150).sum()
             # Mean reduction
             D_total = images_flat.size(0) * images_flat.size(1)
             loss_mean = loss/D_total
 
+        # --- Full matrix, Kronecker eigenbasis ---
+        elif option == 5:
+            loss = fused_nll(kronecker_gaussian, images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss/D_total
+
+        # --- Fourier-domain (Whittle) calculation ---
+        elif option == 6:
+            loss = whittle_gaussian.nll(images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss/D_total
+
+        # --- Truncated full matrix, sparse Cholesky ---
+        elif option == 9:
+            loss = sparse_gaussian.nll(images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss/D_total
+
+        # --- Sparse precision (GMRF) calculation ---
+        elif option == 10:
+            loss = gmrf_gaussian.nll(images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss/D_total
+
+        # --- Low rank plus diagonal calculation ---
+        elif option == 11:
+            loss = low_rank_gaussian.nll(images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss/D_total
+
+        # --- Full matrix, conjugate gradients ---
+        elif option == 12:
+            loss = pcg_gaussian.nll(images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss/D_total
+
+        # --- Full matrix, hierarchical factorisation ---
+        elif option == 14:
+            loss = hodlr_gaussian.nll(images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss/D_total
+
         else:
-            print("Invalid option. Please choose 1, 2, 3, or 4.")
+            print("Invalid option. Please choose 1 to 6, 9 to 12 or 14.")
             break
         bits_per_dim = loss / (images.size(0) * images.size(2) * images.size(3)*np.log(2))  # Divide by log(2) to convert to bits per dim.
 
@@ -258,14 +341,65 @@ while iteration < num_training_updates:
 
             # --- Full Covariance Matrix Calculation ---
             if option==3:
-                mvn = MultivariateNormal(loc=recon_val_flat, scale_tril=scale_tril)
-                loss_val = -mvn.log_prob(val_images_flat).sum
+                # Same engine and precision policy as training, one solve for both
+                mahalanobis_val = full_gaussian.mahalanobis(val_images_flat, recon_val_flat)
+                loss_val = 0.5 * (mahalanobis_val + full_gaussian.log_det + full_gaussian.d * np.log(2 * np.pi)).sum()
+
+                # Malahanobis Distance
+                mahalanobis_distance_val = mahalanobis_val.sum()
+
+            # --- Full Covariance Matrix, Kronecker eigenbasis ---
+            if option==5:
+                loss_val = kronecker_gaussian.nll(val_images_flat, recon_val_flat).sum()
+
+                # Malahanobis Distance
+                mahalanobis_distance_val = kronecker_gaussian.mahalanobis(val_images_flat, recon_val_flat).sum()
+
+            # --- Fourier-domain (Whittle) Calculation ---
+            if option==6:
+                loss_val = whittle_gaussian.nll(val_images_flat, recon_val_flat).sum()
+
+                # Malahanobis Distance
+                mahalanobis_distance_val = whittle_gaussian.mahalanobis(val_images_flat, recon_val_flat).sum()
+
+            # --- Truncated full matrix, sparse Cholesky ---
+            if option==9:
+                loss_val = sparse_gaussian.nll(val_images_flat, recon_val_flat).sum()
 
                 # Malahanobis Distance
-                D_total_val = val_images_flat.size(0) * val_images_flat.size(1)
-                log_det = 2 * torch.sum(torch.log(torch.diag(scale_tril)))
-                mahalanobis_distance_val = 2 * loss_val - val_images_flat.size(0) * log_det - D_total_val * np.log(2 * np.pi)
+                mahalanobis_distance_val = sparse_gaussian.mahalanobis(val_images_flat, recon_val_flat).sum()
 
+            # --- Sparse precision (GMRF) calculation ---
+            if option==10:
+                loss_val = gmrf_gaussian.nll(val_images_flat, recon_val_flat).sum()
+
+                # Malahanobis Distance
+                mahalanobis_distance_val = gmrf_gaussian.mahalanobis(val_images_flat, recon_val_flat).sum()
+
+            # --- Low rank plus diagonal calculation ---
+            if option==11:
+                loss_val = low_rank_gaussian.nll(val_images_flat, recon_val_flat).sum()
+
+                # Malahanobis Distance
+                mahalanobis_distance_val = low_rank_gaussian.mahalanobis(val_images_flat, recon_val_flat).sum()
+
+            # --- Full matrix, conjugate gradients ---
+            if option==12:
+                # One solve gives both the Mahalanobis distance and the NLL
+                mahalanobis_val = pcg_gaussian.mahalanobis(val_images_flat, recon_val_flat)
+                loss_val = 0.5 * (mahalanobis_val + pcg_gaussian.log_det + pcg_gaussian.d * np.log(2 * np.pi)).sum()
+
+                # Malahanobis Distance
+                mahalanobis_distance_val = mahalanobis_val.sum()
+
+            # --- Full matrix, hierarchical factorisation ---
+            if option==14:
+                # One solve gives both the Mahalanobis distance and the NLL
+                mahalanobis_val = hodlr_gaussian.mahalanobis(val_images_flat, recon_val_flat)
+                loss_val = 0.5 * (mahalanobis_val + hodlr_gaussian.log_det + hodlr_gaussian.d * np.log(2 * np.pi)).sum()
+
+                # Malahanobis Distance
+                mahalanobis_distance_val = mahalanobis_val.sum()
             
 
 
@@ -304,4 +438,6 @@ model_save_path = os.path.join(save_directory, 'autoencoder_model.pth')
 torch.save(autoencoder.state_dict(), model_save_path)
 print("Model saved to", model_save_path)
 
+if option not in (5, 6, 9, 10, 11, 12, 14):
+    shared_factors.close()
 wandb.finish()
@@ -1,4 +1,6 @@
 import os
+import signal
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
@@ -12,41 +14,22 @@ from torch.distributions import Normal, MultivariateNormal
 from encoder import Encoder
 from decoder import Decoder
 import plotting_functions
+from shared_factors import shared_psf_factors
+from likelihoods import (
+    BandedGaussian,
+    BlockDiagonalGaussian,
+    CholeskyGaussian,
+    TileGaussian,
+    VecchiaGaussian,
+    fused_nll,
+)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 option = 4
 # option 1: Identity matrix, option 2: 1/9 of the matrix, option 3: Full matrix, option 4: Block diag
-
-def mvg_nll_block(cov, x, mu, n):
-    batch_size, d = x.shape
-    num_blocks = d // n
-    remainder = d % n
-
-    log_likelihood = torch.zeros(batch_size, device=device)
-    z = x - mu
-
-    # Process full blocks
-    for i in range(num_blocks):
-        B = cov[i * n:(i + 1) * n, i * n:(i + 1) * n].to(device)  # Block covariance matrix
-        L = torch.linalg.cholesky(B)  # Cholesky decomposition
-        mvn = MultivariateNormal(torch.zeros(n, device=device), scale_tril=L)
-        
-        z_i = z[:, i * n:(i + 1) * n]
-        log_likelihood += mvn.log_prob(z_i)
-
-    # Process remainder block if it exists
-    if remainder > 0:
-        B_rem = cov[-remainder:, -remainder:].to(device)  # Remainder block covariance matrix
-        L_rem = torch.linalg.cholesky(B_rem)
-        mvn_rem = MultivariateNormal(torch.zeros(remainder, device=device), scale_tril=L_rem)
-        
-        z_rem = z[:, num_blocks * n:]
-        log_likelihood += mvn_rem.log_prob(z_rem)
-
-    return -log_likelihood  # Return batch-wise loss
-
-
+# option 7: Block diag with 2D k x k tiles, option 8: Banded matrix
+# option 13: Vecchia, each pixel conditioned on its m nearest previous pixels
 
 class MemoryMappedDataset(Dataset):
     def __init__(self, mmap_data, device):
@@ -61,25 +44,6 @@ class MemoryMappedDataset(Dataset):
         return torch.tensor(self.data[idx], dtype=torch.float32)
 
 
-def find_correlation_matrix(image_size, sigma):
-    """
-    Create a pixel-to-pixel correlation matrix for a square image.
-    Inputs:
-      - image_size: height/width of the image
-      - sigma: standard deviation used in the Gaussian correlation.
-    """
-    x, y = np.meshgrid(np.arange(image_size), np.arange(image_size), indexing="ij")
-    pixel_coords = np.stack((x.ravel(), y.ravel()), axis=1)
-    i, j = pixel_coords[:, 0], pixel_coords[:, 1]
-
-    di = i[:, None] - i[None, :]  # Difference in x for all pairs
-    dj = j[:, None] - j[None, :]  # Difference in y for all pairs
-    d = 1.8 * np.sqrt(di**2 + dj**2)  # Scaled Euclidean distances
-
-    C = (1 / np.sqrt(2 * np.pi * sigma**2)) * np.exp(-d**2 / (2 * sigma**2))
-    np.fill_diagonal(C, 1)  # Set diagonal to 1
-    return C
-
 # Data loading paths
 train_data_path = '/share/nas2_3/amahmoud/week5/galaxy_out/train_data.npy'
 valid_data_path = '/share/nas2_3/amahmoud/week5/galaxy_out/valid_data_original.npy'
@@ -115,8 +79,16 @@ learning_rate = 2e-4
 num_training_updates = 1000
 sigma = 5.4 / (2 * np.sqrt(2 * np.log(2)))
 image_size = 150
+# Factors are reused across launches from here
+cache_directory = '/share/nas2_3/adey/astro/covariance_cache/'
 # Block diagonal size
 n=12
+# 2D tile size (option 7), tiles hold tile_size**2 pixels
+tile_size = 12
+# Bandwidth (option 8), in flattened pixels; one image row reaches the pixel below
+bandwidth = image_size
+# Conditioning pixels per pixel (option 13)
+vecchia_neighbours = 30
 
 wandb.init(
     project="Covariance_Estimation",
@@ -137,9 +109,24 @@ iteration = 0
 autoencoder.train()
 
 #print('Getting Covariance Matrix & Cholesky Component...')
-correlation_matrix = find_correlation_matrix(image_size, sigma)
-
-cov = torch.tensor(correlation_matrix, dtype=torch.float32, device=device)
+if option in (2, 3):
+    # SIGTERM (e.g. from the scheduler) exits through atexit, which releases the shared factors
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    # Built once per node and shared with the other option scripts running alongside
+    shared_factors = shared_psf_factors(image_size, sigma, cache_directory)
+    correlation_matrix = shared_factors.tensors["correlation_matrix"]
+    scale_tril = shared_factors.tensors["scale_tril"].to(device)
+    full_gaussian = CholeskyGaussian(scale_tril, log_det=shared_factors.tensors["log_det"].item())
+if option == 4:
+    # Block factors and log-determinant depend only on the kernel and n, so build them once.
+    # The covariance is stationary, so only the 25 distinct row-wrap patterns are factorised.
+    block_gaussian = BlockDiagonalGaussian.from_psf(image_size, sigma, n, device=device)
+if option == 7:
+    tile_gaussian = TileGaussian.from_psf(image_size, sigma, tile_size, device=device)
+if option == 8:
+    banded_gaussian = BandedGaussian.from_psf(image_size, sigma, bandwidth, device=device)
+if option == 13:
+    vecchia_gaussian = VecchiaGaussian.from_psf(image_size, sigma, vecchia_neighbours, device=device)
 print("Starting training...")
 while iteration < num_training_updates:
     for images in train_loader:
@@ -205,8 +192,8 @@ while iteration < num_training_updates:
 
         # --- Full matrix calculation ---
         elif option == 3:
-            mvn = MultivariateNormal(loc=recon_flat, scale_tril=scale_tril)
-            loss = -mvn.log_prob(images_flat).sum()
+            # Fused NLL: autograd keeps only the whitened residual
+            loss = fused_nll(full_gaussian, images_flat, recon_flat).sum()
             # Malahanobis distance
             D_total = images_flat.size(0) * images_flat.size(1)  
             # Mean Reduction.
@@ -214,12 +201,30 @@ while iteration < num_training_updates:
 
         elif option == 4:
             # Block diagonal calculation
-            loss = mvg_nll_block(cov, images_flat, recon_flat, n)
+            loss = fused_nll(block_gaussian, images_flat, recon_flat).sum()
             D_total = images_flat.size(0) * images_flat.size(1)  
             loss_mean = loss / D_total
 
+        elif option == 7:
+            # 2D tile block diagonal calculation
+            loss = fused_nll(tile_gaussian, images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss / D_total
+
+        elif option == 8:
+            # Banded matrix calculation
+            loss = fused_nll(banded_gaussian, images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss / D_total
+
+        elif option == 13:
+            # Vecchia nearest-neighbour calculation
+            loss = fused_nll(vecchia_gaussian, images_flat, recon_flat).sum()
+            D_total = images_flat.size(0) * images_flat.size(1)
+            loss_mean = loss / D_total
+
         else:
-            print("Invalid option. Please choose 1, 2, 3, or 4.")
+            print("Invalid option. Please choose 1, 2, 3, 4, 7, 8 or 13.")
             break
         bits_per_dim = loss / (images.size(0) * images.size(2) * images.size(3)*np.log(2))  # Divide by log(2) to convert to bits per dim.
 
@@ -298,9 +303,24 @@ while iteration < num_training_updates:
                 mahalanobis_distance_val = 2 * loss_val - val_images_flat.size(0) * log_det - D_total_val * np.log(2 * np.pi)
             
             if option==4:
-                loss = mvg_nll_block(cov, val_images_flat, recon_val_flat, n)
+                loss_val = block_gaussian.nll(val_images_flat, recon_val_flat).sum()
                 D_total = val_images_flat.size(0) * val_images_flat.size(1)  
-                loss_mean = loss / D_total
+                loss_mean = loss_val / D_total
+
+            if option==7:
+                loss_val = tile_gaussian.nll(val_images_flat, recon_val_flat).sum()
+                D_total = val_images_flat.size(0) * val_images_flat.size(1)
+                loss_mean = loss_val / D_total
+
+            if option==8:
+                loss_val = banded_gaussian.nll(val_images_flat, recon_val_flat).sum()
+                D_total = val_images_flat.size(0) * val_images_flat.size(1)
+                loss_mean = loss_val / D_total
+
+            if option==13:
+                loss_val = vecchia_gaussian.nll(val_images_flat, recon_val_flat).sum()
+                D_total = val_images_flat.size(0) * val_images_flat.size(1)
+                loss_mean = loss_val / D_total
 
 
             bits_per_dim_val = loss_val / (val_images.size(0) * val_images.size(2) * val_images.size(3) * np.log(2))
@@ -338,4 +358,6 @@ model_save_path = os.path.join(save_directory, 'autoencoder_model.pth')
 torch.save(autoencoder.state_dict(), model_save_path)
 print("Model saved to", model_save_path)
 
+if option in (2, 3):
+    shared_factors.close()
 wandb.finish()
@@ -0,0 +1,210 @@
+import numpy as np
+import torch
+
+from covariance import find_beam_kernel, find_correlation_kernel
+
+
+def _circulant_embedding(kernel):
+    """
+    Embed a (2n-1, 2n-1) lag kernel in a (2n, 2n) periodic array, with negative
+    lags wrapped around, so that the covariance is the top-left (n, n) window of
+    the corresponding 2D circulant.
+    """
+    image_size = (kernel.shape[0] + 1) // 2
+    pad_size = 2 * image_size
+    lags = np.arange(-(image_size - 1), image_size) % pad_size
+    circulant = np.zeros((pad_size, pad_size))
+    circulant[np.ix_(lags, lags)] = kernel
+    return circulant
+
+
+class _PSFMatmul(torch.autograd.Function):
+    """
+    Sigma @ v as an autograd op. Sigma is symmetric, so the backward pass is
+    another matvec and nothing needs to be saved for it.
+    """
+
+    @staticmethod
+    def forward(ctx, v, operator):
+        ctx.operator = operator
+        return operator._apply(v)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return ctx.operator._apply(grad_output), None
+
+
+class PSFCovarianceOperator:
+    """
+    Matrix-free PSF covariance. In row-major pixel order the stationary
+    covariance is block-Toeplitz with Toeplitz blocks, so Sigma @ v is a 2D
+    linear convolution of the image with the lag kernel. This is done by
+    zero-padding to a (2n, 2n) circulant and multiplying in rfft2 space, in
+    O(N log N) per image, while only the kernel spectrum is stored.
+    """
+
+    def __init__(self, kernel, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - kernel: (2n-1, 2n-1) lag kernel, as from find_correlation_kernel.
+          - device, dtype: where and how the kernel spectrum is stored.
+        """
+        circulant = _circulant_embedding(kernel)
+        image_size = (kernel.shape[0] + 1) // 2
+
+        self.image_size = image_size
+        self.pad_size = circulant.shape[0]
+        self.shape = (image_size**2, image_size**2)
+        self.dtype = dtype
+        # The kernel is real and even, so its spectrum is real
+        self.kernel_fft = torch.tensor(np.fft.rfft2(circulant).real, dtype=dtype, device=device)
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, pixel_scale=1.8, device=None, dtype=torch.float32):
+        """
+        Operator for the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        return cls(find_correlation_kernel(image_size, sigma, pixel_scale), device=device, dtype=dtype)
+
+    @classmethod
+    def from_beam(cls, image_size, fwhm_major, fwhm_minor, pixel_scale=1.8, position_angle=0.0,
+                  device=None, dtype=torch.float32):
+        """
+        Operator for an elliptical beam, as in find_beam_covariance_matrix.
+        """
+        kernel = find_beam_kernel(image_size, fwhm_major, fwhm_minor, pixel_scale, position_angle)
+        return cls(kernel, device=device, dtype=dtype)
+
+    def _apply(self, v):
+        n, p = self.image_size, self.pad_size
+        images = v.reshape(-1, n, n)
+        spectrum = torch.fft.rfft2(images, s=(p, p)) * self.kernel_fft
+        out = torch.fft.irfft2(spectrum, s=(p, p))[:, :n, :n]
+        return out.reshape(v.shape)
+
+    def matvec(self, v):
+        """
+        Inputs:
+          - v: (image_size**2,) or (batch, image_size**2) flattened images.
+        Outputs:
+          - Sigma @ v for each image, same shape as v. Differentiable in v.
+        """
+        return _PSFMatmul.apply(v, self)
+
+    def __matmul__(self, v):
+        return self.matvec(v)
+
+    def to_dense(self):
+        """
+        The full matrix, only for checks on small images.
+        """
+        eye = torch.eye(self.shape[0], dtype=self.dtype, device=self.kernel_fft.device)
+        return self._apply(eye)
+
+    def to_linear_operator(self):
+        """
+        scipy.sparse.linalg.LinearOperator wrapper, for use with scipy solvers
+        and eigensolvers on NumPy arrays.
+        """
+        from scipy.sparse.linalg import LinearOperator
+
+        device = self.kernel_fft.device
+
+        def matmat(V):
+            V = torch.as_tensor(np.ascontiguousarray(V.T), dtype=self.dtype, device=device)
+            return self._apply(V).cpu().numpy().T
+
+        return LinearOperator(
+            self.shape,
+            matvec=lambda v: matmat(v.reshape(-1, 1)).ravel(),
+            matmat=matmat,
+            rmatvec=lambda v: matmat(v.reshape(-1, 1)).ravel(),
+            dtype=np.float64 if self.dtype == torch.float64 else np.float32,
+        )
+
+
+class PSFNoiseSampler:
+    """
+    Exact samples of PSF-correlated noise by circulant embedding.
+
+    The (2n, 2n) circulant that contains the covariance is diagonalised by the
+    2D FFT, so with its eigenvalues lam a complex white field eps gives
+        fft2(sqrt(lam / P^2) * eps)
+    whose real and imaginary parts are two independent draws from the circulant.
+    Cropping to (n, n) leaves exact draws from the covariance. Each pair of
+    fields costs one (2n, 2n) FFT; no factor of the N x N matrix is formed.
+    """
+
+    def __init__(self, kernel, scale=1.0, seed=None, device=None, dtype=torch.float32):
+        """
+        Inputs:
+          - kernel: (2n-1, 2n-1) lag kernel, as from find_correlation_kernel.
+          - scale: noise level (e.g. sigma_rms) multiplying every sample.
+          - seed: seed for the sampler's own torch.Generator.
+          - device, dtype: where and how the samples are produced.
+        """
+        circulant = _circulant_embedding(kernel)
+        eigenvalues = np.fft.fft2(circulant).real
+        if eigenvalues.min() < -1e-8 * eigenvalues.max():
+            raise ValueError(
+                "Circulant embedding is not positive semi-definite (min eigenvalue "
+                f"{eigenvalues.min():.3e}); the kernel cannot be sampled exactly this way."
+            )
+        eigenvalues = np.clip(eigenvalues, 0, None)
+
+        self.image_size = (kernel.shape[0] + 1) // 2
+        self.pad_size = circulant.shape[0]
+        self.device = device
+        self.dtype = dtype
+        self.sqrt_eigenvalues = torch.tensor(
+            scale * np.sqrt(eigenvalues) / self.pad_size, dtype=dtype, device=device
+        )
+        self.generator = torch.Generator(device=device if device is not None else "cpu")
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    @classmethod
+    def from_psf(cls, image_size, sigma, pixel_scale=1.8, scale=1.0, seed=None, device=None, dtype=torch.float32):
+        """
+        Sampler for the covariance from find_correlation_matrix(image_size, sigma).
+        """
+        kernel = find_correlation_kernel(image_size, sigma, pixel_scale)
+        return cls(kernel, scale=scale, seed=seed, device=device, dtype=dtype)
+
+    def sample(self, num_samples):
+        """
+        Inputs:
+          - num_samples: number of noise fields to draw.
+        Outputs:
+          - (num_samples, image_size, image_size) tensor of correlated noise.
+        """
+        n, p = self.image_size, self.pad_size
+        num_pairs = (num_samples + 1) // 2
+        shape = (num_pairs, p, p)
+        real = torch.randn(shape, generator=self.generator, device=self.device, dtype=self.dtype)
+        imag = torch.randn(shape, generator=self.generator, device=self.device, dtype=self.dtype)
+
+        fields = torch.fft.fft2(torch.complex(real, imag) * self.sqrt_eigenvalues)[:, :n, :n]
+        return torch.cat((fields.real, fields.imag))[:num_samples]
+
+    def stream(self, batch_size):
+        """
+        Endless generator of (batch_size, image_size, image_size) noise batches.
+        """
+        while True:
+            yield self.sample(batch_size)
+
+
+def sparse_to_torch(matrix, device=None, dtype=torch.float32):
+    """
+    Convert a scipy sparse matrix (e.g. from find_sparse_correlation_matrix) to
+    a torch sparse CSR tensor, for torch.sparse.mm matvecs on flattened images.
+    """
+    matrix = matrix.tocsr()
+    return torch.sparse_csr_tensor(
+        torch.tensor(matrix.indptr, dtype=torch.int64),
+        torch.tensor(matrix.indices, dtype=torch.int64),
+        torch.tensor(matrix.data, dtype=dtype),
+        size=matrix.shape,
+        device=device,
+    )
@@ -0,0 +1,235 @@
+import atexit
+import fcntl
+import json
+import os
+import secrets
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import torch
+
+from covariance_cache import CovarianceCache, cached_cholesky_factor, cached_correlation_matrix
+
+_HEADER_SIZE = 64 * 1024  # Holder PIDs followed by JSON metadata
+_MAX_HOLDERS = 256
+_METADATA_OFFSET = 8 * _MAX_HOLDERS
+
+
+def _open_segment(name, create=False, size=0):
+    # Lifetime is managed by the reference count below, not by the interpreter
+    # that happens to create or open the segment
+    try:
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:  # Python < 3.13 has no track argument
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def _unlink_segment(segment):
+    if getattr(segment, "_track", True):
+        # Python < 3.13 unregisters on unlink, so register it back first
+        resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, owned by another user
+    return True
+
+
+class SharedFactors:
+    """
+    Read-only arrays (covariance, Cholesky factor, log-determinant, ...) published
+    once into POSIX shared memory and attached zero-copy as torch tensors by any
+    number of training processes on the node.
+
+    A header segment holds the PIDs of the holding processes and the array
+    layouts. The publisher and every attached process each hold one slot;
+    whoever drops the last one unlinks the segments, so the publisher may exit
+    while others are still training. References are dropped by close(), which
+    is also registered with atexit. Slots of processes that died without
+    closing (SIGKILL, OOM kill) are reclaimed by the next attach or close, and
+    segments with no live holder left are unlinked. The tensors share memory
+    with every process and must not be written to.
+    """
+
+    def __init__(self, name, header, segments, metadata):
+        self.name = name
+        self._header = header
+        self._segments = segments
+        self.tensors = {
+            array_name: torch.from_numpy(
+                np.ndarray(layout["shape"], dtype=layout["dtype"], buffer=segments[array_name].buf)
+            )
+            for array_name, layout in metadata["arrays"].items()
+        }
+        atexit.register(self.close)
+
+    @staticmethod
+    @contextmanager
+    def _lock(name):
+        with open(os.path.join(tempfile.gettempdir(), name + ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _holders(header):
+        return np.ndarray((_MAX_HOLDERS,), dtype=np.int64, buffer=header.buf)
+
+    @classmethod
+    def _live_holders(cls, header):
+        """
+        Clear the slots of dead processes and return the number still held.
+        Call with the lock held.
+        """
+        holders = cls._holders(header)
+        for slot in np.flatnonzero(holders):
+            if not _is_alive(int(holders[slot])):
+                holders[slot] = 0
+        return int(np.count_nonzero(holders))
+
+    def _add_reference(self):
+        holders = self._holders(self._header)
+        free = np.flatnonzero(holders == 0)
+        if len(free) == 0:
+            raise RuntimeError(f"More than {_MAX_HOLDERS} processes attached to {self.name}.")
+        holders[free[0]] = os.getpid()
+
+    def _drop_reference(self):
+        """
+        Release this process's slot and return the number of live holders left.
+        """
+        holders = self._holders(self._header)
+        mine = np.flatnonzero(holders == os.getpid())
+        if len(mine):
+            holders[mine[0]] = 0
+        return self._live_holders(self._header)
+
+    @classmethod
+    def publish(cls, name, arrays):
+        """
+        Copy a dict of name -> array into shared memory under name.
+        Raises FileExistsError if another process already published it.
+        """
+        token = secrets.token_hex(4)
+        segments, layouts = {}, {}
+        try:
+            for array_name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                segment = _open_segment(f"{name}-{token}-{array_name}", create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+                segments[array_name] = segment
+                layouts[array_name] = {"segment": segment.name, "shape": array.shape, "dtype": array.dtype.str}
+
+            metadata = json.dumps({"arrays": layouts}).encode()
+            with cls._lock(name):
+                # The header is created last, so attaching processes only see complete arrays
+                header = _open_segment(name, create=True, size=_HEADER_SIZE)
+                header.buf[_METADATA_OFFSET:_METADATA_OFFSET + len(metadata)] = metadata
+                shared = cls(name, header, segments, {"arrays": layouts})
+                shared._add_reference()
+        except BaseException:
+            for segment in segments.values():
+                segment.close()
+                _unlink_segment(segment)
+            raise
+        return shared
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attach to arrays published under name. Raises FileNotFoundError if none
+        are, or if every process holding them has died (the stale segments are
+        then unlinked).
+        """
+        with cls._lock(name):
+            header = _open_segment(name)
+            metadata = json.loads(bytes(header.buf[_METADATA_OFFSET:]).rstrip(b"\0"))
+            segments = {
+                array_name: _open_segment(layout["segment"])
+                for array_name, layout in metadata["arrays"].items()
+            }
+            if cls._live_holders(header) == 0:
+                for segment in list(segments.values()) + [header]:
+                    segment.close()
+                    _unlink_segment(segment)
+                raise FileNotFoundError(f"{name} was left behind by processes that have exited.")
+            shared = cls(name, header, segments, metadata)
+            shared._add_reference()
+        return shared
+
+    @classmethod
+    def attach_or_publish(cls, name, compute):
+        """
+        Attach to name if published, otherwise publish compute() -> dict of arrays.
+        A build lock is held from the attach attempt until publishing, so
+        processes starting together compute once: the others wait, then attach.
+        """
+        with cls._lock(name + ".build"):
+            try:
+                return cls.attach(name)
+            except FileNotFoundError:
+                return cls.publish(name, compute())
+
+    def close(self):
+        """
+        Drop this process's reference, unlinking the segments if no live holder
+        is left. Safe to call more than once. Tensors taken from self.tensors
+        stay valid until they are freed.
+        """
+        if self._header is None:
+            return
+        self.tensors = {}
+        with self._lock(self.name):
+            remaining = self._drop_reference()
+            segments = list(self._segments.values()) + [self._header]
+            for segment in segments:
+                try:
+                    segment.close()
+                except BufferError:
+                    pass  # Still referenced by tensors; unmapped when they are freed
+                if remaining == 0:
+                    _unlink_segment(segment)
+        self._segments = {}
+        self._header = None
+        atexit.unregister(self.close)
+
+
+def shared_psf_factors(image_size, sigma, cache_directory, pixel_scale=1.8, max_bytes=20 * 1024**3,
+                       dtype=np.float32):
+    """
+    Correlation matrix (float32), Cholesky factor and log-determinant of the
+    PSF covariance, shared by every process on the node. The first process
+    loads them from the on-disk cache (building them once if needed) and
+    publishes them.
+    Inputs:
+      - max_bytes: size bound of the CovarianceCache in cache_directory.
+      - dtype: dtype of the Cholesky factor, rounded once from the float64
+        factorisation (float64 for the float64 precision policy).
+    Outputs:
+      - SharedFactors with tensors "correlation_matrix", "scale_tril" and "log_det".
+    """
+    def compute():
+        cache = CovarianceCache(cache_directory, max_bytes=max_bytes)
+        scale_tril, log_det = cached_cholesky_factor(cache, image_size, sigma, pixel_scale, dtype=dtype)
+        return {
+            "correlation_matrix": cached_correlation_matrix(cache, image_size, sigma, pixel_scale),
+            "scale_tril": scale_tril,
+            "log_det": np.array([log_det]),
+        }
+
+    name = "psf_factors_" + CovarianceCache.key(
+        image_size=image_size, sigma=sigma, pixel_scale=pixel_scale, dtype=dtype
+    )[:16]
+    return SharedFactors.attach_or_publish(name, compute)
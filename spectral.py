@@ -0,0 +1,202 @@
+import numpy as np
+import torch
+
+from psf_operator import PSFCovarianceOperator
+
+
+def randomized_eigenpairs(operator, k, oversample=10, num_iter=6, seed=None):
+    """
+    Leading eigenpairs of a symmetric positive semi-definite operator by
+    randomized subspace iteration (Halko, Martinsson & Tropp, 2011), using
+    only batched matvecs: k + oversample random probes are pushed through the
+    operator num_iter + 1 times, re-orthonormalised each time, and the
+    operator is then diagonalised on the (k + oversample)-dimensional subspace.
+    Inputs:
+      - operator: (N, N) operator with matvec on (batch, N) tensors, e.g.
+        PSFCovarianceOperator (float64 is recommended).
+      - k: number of eigenpairs.
+      - oversample: extra probes, which sharpen the trailing pairs.
+      - num_iter: power iterations. The PSF spectrum is clustered (degenerate
+        pairs on top of its unit-diagonal floor), so convergence is slow and
+        the trailing eigenvalues are only good to a few percent; use
+        lanczos_eigenpairs when they must be accurate.
+      - seed: seed for the random probes.
+    Outputs:
+      - eigenvalues: (k,) np.ndarray, in descending order
+      - eigenvectors: (N, k) np.ndarray
+    """
+    N = operator.shape[0]
+    device = operator.kernel_fft.device
+    generator = torch.Generator(device=device)
+    if seed is not None:
+        generator.manual_seed(seed)
+
+    with torch.no_grad():
+        probes = torch.randn(k + oversample, N, generator=generator, device=device, dtype=operator.dtype)
+        for _ in range(num_iter + 1):
+            Q = torch.linalg.qr((operator @ probes).T).Q  # (N, k + oversample)
+            probes = Q.T
+        projected = probes @ (operator @ probes).T
+        eigenvalues, vectors = torch.linalg.eigh((projected + projected.T) / 2)
+        top = torch.argsort(eigenvalues, descending=True)[:k]
+        return eigenvalues[top].cpu().numpy(), (Q @ vectors[:, top]).cpu().numpy()
+
+
+def lanczos_eigenpairs(operator, k, tol=0):
+    """
+    Leading eigenpairs by implicitly restarted Lanczos (scipy eigsh / ARPACK)
+    on operator.to_linear_operator(). Slower than randomized_eigenpairs but
+    accurate to tol in every pair (k = 50 at 300x300 takes about a minute on
+    one CPU thread).
+    Outputs:
+      - eigenvalues: (k,) np.ndarray, in descending order
+      - eigenvectors: (N, k) np.ndarray
+    """
+    from scipy.sparse.linalg import eigsh
+
+    eigenvalues, eigenvectors = eigsh(operator.to_linear_operator(), k=k, which="LA", tol=tol)
+    order = np.argsort(eigenvalues)[::-1]
+    return eigenvalues[order], eigenvectors[:, order]
+
+
+def leading_eigenpairs(operator, k, method="lanczos", **kwargs):
+    """
+    Leading eigenpairs of operator with method "lanczos" or "randomized".
+    """
+    if method == "randomized":
+        return randomized_eigenpairs(operator, k, **kwargs)
+    if method == "lanczos":
+        return lanczos_eigenpairs(operator, k, **kwargs)
+    raise ValueError(f"Unknown eigensolver {method!r}; use 'randomized' or 'lanczos'.")
+
+
+def _lanczos(matvec, probes, num_steps):
+    """
+    num_steps of Lanczos from each row of probes at once, with full
+    reorthogonalisation.
+    Outputs:
+      - basis: (num_probes, num_steps, N) orthonormal Lanczos vectors
+      - tridiagonal: (num_probes, num_steps, num_steps) Lanczos matrices T
+    """
+    q = probes / probes.norm(dim=1, keepdim=True)
+    basis, alphas, betas = [q], [], []
+    for step in range(num_steps):
+        w = matvec(q)
+        alphas.append((w * q).sum(dim=1))
+        Q = torch.stack(basis, dim=1)
+        w = w - torch.einsum("mjn,mj->mn", Q, torch.einsum("mjn,mn->mj", Q, w))
+        w = w - torch.einsum("mjn,mj->mn", Q, torch.einsum("mjn,mn->mj", Q, w))  # Twice is enough
+        if step == num_steps - 1:
+            break
+        beta = w.norm(dim=1).clamp_min(torch.finfo(w.dtype).tiny)
+        betas.append(beta)
+        q = w / beta[:, None]
+        basis.append(q)
+
+    tridiagonal = torch.diag_embed(torch.stack(alphas, dim=1))
+    if betas:
+        off_diagonal = torch.diag_embed(torch.stack(betas, dim=1), offset=1)
+        tridiagonal = tridiagonal + off_diagonal + off_diagonal.mT
+    return torch.stack(basis, dim=1), tridiagonal
+
+
+class StochasticLogDet:
+    """
+    Matrix-free log-determinant by stochastic Lanczos quadrature: with
+    Rademacher probes z (E[z z^T] = I),
+        log|Sigma| = tr(log Sigma) ~ mean_z  |z|^2 e1^T log(T_z) e1
+    where T_z is the Lanczos matrix of Sigma started from z. Only batched
+    matvecs with Sigma are needed, one per Lanczos step for all probes.
+
+    The estimate is differentiable in whatever the matvec depends on (e.g. a
+    learned PSF width): d log|Sigma| = tr(Sigma^-1 dSigma) is estimated by
+    Hutchinson as mean_z u^T dSigma z, with u = Sigma^-1 z read off the same
+    Lanczos basis, so autograd goes through one matvec instead of the
+    whole recurrence. Variance is controlled by num_probes (as
+    1/sqrt(num_probes)), bias by num_steps. The probes are drawn once and
+    reused, so the estimate is a smooth function of the parameters during
+    training.
+    """
+
+    def __init__(self, d, num_probes=16, num_steps=30, seed=0, device=None, dtype=torch.float64):
+        """
+        Inputs:
+          - d: dimension of the covariance (image_size**2).
+          - num_probes, num_steps: Hutchinson probes and Lanczos steps per probe.
+          - seed: seed of the cached probes.
+          - device, dtype: where and how the probes are stored.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        signs = torch.randint(0, 2, (num_probes, d), generator=generator)
+        self.probes = (2 * signs - 1).to(device=device, dtype=dtype)
+        self.num_steps = num_steps
+
+    def __call__(self, matvec):
+        """
+        Inputs:
+          - matvec: callable mapping (batch, d) tensors to Sigma @ each row,
+            e.g. PSFCovarianceOperator.matvec. Sigma must be symmetric positive definite.
+        Outputs:
+          - scalar tensor estimating log|Sigma|, differentiable through matvec.
+        """
+        z = self.probes
+        with torch.no_grad():
+            basis, T = _lanczos(matvec, z, self.num_steps)
+            theta, S = torch.linalg.eigh(T)
+            norms = (z**2).sum(dim=1)
+            estimate = (norms * (S[:, 0]**2 * torch.log(theta)).sum(dim=1)).mean()
+
+            # Sigma^-1 z = |z| Q T^-1 e1 on the Lanczos basis
+            e1 = torch.zeros_like(T[:, :, 0])
+            e1[:, 0] = 1
+            coefficients = torch.linalg.solve(T, e1)
+            u = norms.sqrt()[:, None] * torch.einsum("mjn,mj->mn", basis, coefficients)
+
+        # Same value as the estimate, with the Hutchinson gradient of the log-determinant
+        surrogate = (u * matvec(z)).sum(dim=1).mean()
+        return estimate + surrogate - surrogate.detach()
+
+
+def _cached_eigenpairs(cache, build_operator, k, method, dtype, **params):
+    """
+    Leading eigenpairs of build_operator(), eigenvectors stored in dtype and
+    eigenvalues in float64, keyed by params.
+    """
+    def compute():
+        eigenvalues, eigenvectors = leading_eigenpairs(build_operator(), k, method=method)
+        return {"eigenvalues": eigenvalues.astype(np.float64), "eigenvectors": eigenvectors.astype(dtype)}
+
+    arrays = cache.get_or_compute(compute, k=k, method=method, dtype=dtype, strategy="eigenpairs", **params)
+    return arrays["eigenvalues"], arrays["eigenvectors"]
+
+
+def cached_psf_eigenpairs(cache, image_size, sigma, k, pixel_scale=1.8, method="lanczos", dtype=np.float32):
+    """
+    Leading k eigenpairs of the PSF covariance from find_correlation_matrix,
+    computed matrix-free and stored in a CovarianceCache.
+    Outputs:
+      - eigenvalues: (k,) read-only np.memmap, descending
+      - eigenvectors: (N, k) read-only np.memmap
+    """
+    return _cached_eigenpairs(
+        cache,
+        lambda: PSFCovarianceOperator.from_psf(image_size, sigma, pixel_scale, dtype=torch.float64),
+        k, method, dtype,
+        image_size=image_size, sigma=sigma, pixel_scale=pixel_scale,
+    )
+
+
+def cached_beam_eigenpairs(cache, image_size, fwhm_major, fwhm_minor, k, pixel_scale=1.8, position_angle=0.0,
+                           method="lanczos", dtype=np.float32):
+    """
+    As cached_psf_eigenpairs, for the elliptical beam of find_beam_covariance_matrix.
+    """
+    return _cached_eigenpairs(
+        cache,
+        lambda: PSFCovarianceOperator.from_beam(
+            image_size, fwhm_major, fwhm_minor, pixel_scale, position_angle, dtype=torch.float64
+        ),
+        k, method, dtype,
+        image_size=image_size, fwhm_major=fwhm_major, fwhm_minor=fwhm_minor,
+        pixel_scale=pixel_scale, position_angle=position_angle,
+    )